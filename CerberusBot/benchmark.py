@@ -0,0 +1,196 @@
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from bs4 import BeautifulSoup
+from fixtures import FixtureStore
+from fflogs_extractor import extract_fight_summary
+from parse_pool import parse, warm_up
+from policy import Policy
+from util import load_config
+from web_parser import HTML_Parser
+
+"""
+Offline benchmarks for the Lodestone/FFLogs parsers and the log policy.
+
+Record pages from the live sites once:
+    python benchmark.py record --lodestone [URL] --fflogs [URL]
+Then replay them as often as needed:
+    python benchmark.py run --output results.json
+
+"""
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def measure_peak_memory(func, *args):
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+class Benchmark():
+    def __init__(self, config, store, repeat, workers=2):
+        self.config = config
+        self.store = store
+        self.repeat = repeat
+        self.workers = workers
+        self.web = HTML_Parser(config)
+        self.policy = Policy(config)
+        self.timings = {}
+        self.peaks = {}
+
+    def timed(self, name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.timings.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+
+    def track_memory(self, name, func, *args):
+        self.peaks[name] = max(self.peaks.get(name, 0), measure_peak_memory(func, *args))
+
+    def parse_html5lib(self, page_source):
+        return self.web.summarize_fight(BeautifulSoup(page_source, 'html5lib'))
+
+    # Feeds a recorded Lodestone page to the streaming parser the same way the fetcher does
+    def parse_lodestone_stream(self, page_source, chunk_size=16 * 1024):
+        parser = self.web.lodestone_stream_parser()
+        body = page_source.encode("utf-8")
+        for start in range(0, len(body), chunk_size):
+            if parser.feed_bytes(body[start:start + chunk_size]):
+                break
+        return self.web.lodestone_stream_result(parser)
+
+    # Selects every player of a fight and runs them through the policy
+    def evaluate_players(self, summary):
+        for player in summary["players"] or []:
+            status_code, data = self.timed("select_player_data", self.web.select_player_data, summary, player)
+            if status_code == self.config["error_codes"]["success"]:
+                self.timed("check_drs_logs", self.policy.check_drs_logs, data)
+
+    def run(self):
+        lodestone_pages = list(self.store.load_all("lodestone"))
+        fflogs_pages = list(self.store.load_all("fflogs"))
+        engines = [("html5lib", self.parse_html5lib), ("lxml", extract_fight_summary)]
+
+        # Lodestone
+        for key, page_source in lodestone_pages:
+            for i in range(self.repeat):
+                self.timed("parse_lodestone_html", self.web.parse_lodestone_html, page_source)
+            self.track_memory("parse_lodestone_html", self.web.parse_lodestone_html, page_source)
+            for i in range(self.repeat):
+                self.timed("parse_lodestone_stream", self.parse_lodestone_stream, page_source)
+            self.track_memory("parse_lodestone_stream", self.parse_lodestone_stream, page_source)
+
+        # FFLogs, timing the full parse, select and policy pipeline per engine
+        throughput = {}
+        mismatches = []
+        for engine, parse_page in engines:
+            start = time.perf_counter()
+            for i in range(self.repeat):
+                for key, page_source in fflogs_pages:
+                    summary = self.timed("parse_fight_summary[" + engine + "]", parse_page, page_source)
+                    self.evaluate_players(summary)
+            elapsed = time.perf_counter() - start
+            if elapsed > 0:
+                throughput[engine] = (len(fflogs_pages) * self.repeat) / elapsed
+
+        for key, page_source in fflogs_pages:
+            for engine, parse_page in engines:
+                self.track_memory("parse_fight_summary[" + engine + "]", parse_page, page_source)
+            if self.parse_html5lib(page_source) != extract_fight_summary(page_source):
+                mismatches.append(key)
+
+        return {
+            "fixtures": {"lodestone": len(lodestone_pages), "fflogs": len(fflogs_pages)},
+            "repeat": self.repeat,
+            "throughput_logs_per_second": throughput,
+            "engine_mismatches": mismatches,
+            "parallel_logs_per_second": self.parallel_throughput(fflogs_pages),
+            "functions": self.summarize()
+        }
+
+    # Parses all FFLogs fixtures with a pool of threads and a pool of processes like the bot's parse pool
+    def parallel_throughput(self, fflogs_pages):
+        if len(fflogs_pages) == 0 or self.workers <= 0:
+            return {}
+        engine = self.config.get("log_parser_engine", "lxml")
+        page_sources = [page_source for key, page_source in fflogs_pages] * self.repeat
+        pools = [
+            ("threads", lambda: ThreadPoolExecutor(max_workers=self.workers)),
+            ("processes", lambda: ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")))
+        ]
+
+        throughput = {"workers": self.workers}
+        for kind, create_pool in pools:
+            with create_pool() as executor:
+                list(executor.map(warm_up, [engine] * self.workers))
+                start = time.perf_counter()
+                list(executor.map(parse, page_sources, [engine] * len(page_sources)))
+                elapsed = time.perf_counter() - start
+            if elapsed > 0:
+                throughput[kind] = len(page_sources) / elapsed
+        return throughput
+
+    def summarize(self):
+        functions = {}
+        for name, samples in self.timings.items():
+            functions[name] = {
+                "calls": len(samples),
+                "mean_ms": 1000 * sum(samples) / len(samples),
+                "p50_ms": 1000 * percentile(samples, 0.50),
+                "p95_ms": 1000 * percentile(samples, 0.95),
+                "p99_ms": 1000 * percentile(samples, 0.99),
+                "peak_memory_kb": self.peaks.get(name, 0) / 1024
+            }
+        return functions
+
+# Fetches live pages with HTML_Parser while it records them to the fixture directory
+def record(config, args):
+    config["fixture_record_dir"] = args.fixtures
+    web = HTML_Parser(config)
+    try:
+        for lodestone_url in args.lodestone:
+            status_code, data = web.get_lodestone_data(lodestone_url)
+            print("Recorded" if status_code == config["error_codes"]["success"] else "Failed", lodestone_url)
+        for fflogs_url in args.fflogs:
+            status_code, data = web.render_fight_summary(fflogs_url)
+            print("Recorded" if status_code == config["error_codes"]["success"] else "Failed", fflogs_url)
+    finally:
+        web.close()
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Record and benchmark Lodestone/FFLogs parsing.")
+    arg_parser.add_argument("--config", default="config.json")
+    arg_parser.add_argument("--fixtures", default="fixtures")
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="record live pages as fixtures")
+    record_parser.add_argument("--lodestone", nargs="*", default=[])
+    record_parser.add_argument("--fflogs", nargs="*", default=[])
+
+    run_parser = subparsers.add_parser("run", help="replay fixtures through the parsers and policy")
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--workers", type=int, default=2, help="pool size for the parallel parse throughput")
+    run_parser.add_argument("--output", default="benchmark_results.json")
+
+    args = arg_parser.parse_args()
+    config = load_config(args.config)
+
+    if args.command == "record":
+        record(config, args)
+        return
+
+    results = Benchmark(config, FixtureStore(args.fixtures), args.repeat, args.workers).run()
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,319 @@
+import argparse
+import asyncio
 import os
 import discord
 import hashlib
 from discord.ext import commands
-from db import DB
+from db import DB, ID, VALIDATED, NAME, TOKEN
 from web_parser import HTML_Parser
-from policy import Policy
+from fetcher import AsyncFetcher
+from guilds import GuildSettings
+from log_cache import LogCache
+from member_cache import MemberResolver
+from log_queue import LogCheckQueue
+from policy import REJECTED
+from metrics import MetricsServer, count, get_failure_reason, registry, timer
+from dispatcher import OutboundDispatcher, REVIEW
+from reverify import ReverificationSweep
 from util import load_config
 
-# User Indices
-ID = 0
-VALIDATED = 1
-NAME = 2
-TOKEN = 3
+"""
+The Cerberus bot, serving every guild configured in config.json.
 
-# Class Instances
-sha3 = hashlib.sha3_256()
-intents = discord.Intents.all()
-bot = commands.Bot("!", help_command=None, intents=intents)
-config = load_config()
-db = DB("users.db")
-web = HTML_Parser(config)
-policy = Policy(config)
+The bot is auto-sharded and can be split over several processes with
+shard_ids/shard_count. Discord delivers all DMs, and with them every command,
+to shard 0, so that process resolves members of guilds on other shards over
+REST and is the one running the re-verification sweep.
 
+"""
+class Cerberus(commands.AutoShardedBot):
+    def __init__(self, config, shard_ids=None, shard_count=None):
+        super().__init__("!", help_command=None, intents=discord.Intents.all(), shard_ids=shard_ids, shard_count=shard_count)
+        # Class Instances
+        self.config = config
+        self.sha3 = hashlib.sha3_256()
+        self.guild_settings = GuildSettings(config)
+        self.db = DB(config.get("database", "users.db"))
+        self.web = HTML_Parser(config)
+        self.log_cache = LogCache(config, self.db)
+        self.fetcher = AsyncFetcher(config, self.web, self.log_cache)
+        self.members = MemberResolver(self, config)
+        self.log_queue = LogCheckQueue(config)
+        self.metrics_server = MetricsServer(config)
+        self.outbound = OutboundDispatcher(self, config, self.members)
+        self.reverify = ReverificationSweep(config, self.db, self.fetcher, self.web, self.on_character_changed)
+
+    # Releases the scraping resources on shutdown
+    async def close(self):
+        self.log_queue.stop()
+        self.reverify.stop()
+        await self.outbound.stop()
+        await self.metrics_server.stop()
+        await self.fetcher.close()
+        self.web.close()
+        await super().close()
+
+    def handles_direct_messages(self):
+        return self.shard_ids is None or 0 in self.shard_ids
+
+    def log_message(self, settings, msg):
+        self.outbound.audit(msg, settings["logging_channel_id"])
+
+    # ----------------------------------------------------------------------
+    # Subroutines
+    # ----------------------------------------------------------------------
+    # Returns the settings of the guild a command is for, picking the only configured guild the user is in by default
+    async def get_command_guild(self, ctx, server=None):
+        if server is not None:
+            settings = self.guild_settings.find(server)
+            if settings is None:
+                return (self.config["error_codes"]["failure"], self.config["error_messages"].get("unknown_server", "Unknown server: ") + server)
+            return (self.config["error_codes"]["success"], settings)
+        if len(self.guild_settings.all()) == 1:
+            return (self.config["error_codes"]["success"], self.guild_settings.all()[0])
+
+        shared = await self.get_member_guilds(ctx.author.id)
+        if len(shared) == 1:
+            return (self.config["error_codes"]["success"], shared[0])
+        if len(shared) == 0:
+            return (self.config["error_codes"]["failure"], self.config["error_messages"].get("no_shared_server", "You are not a member of any server using this bot."))
+        names = ", ".join(self.guild_settings.get_name(settings) for settings in shared)
+        return (self.config["error_codes"]["failure"], self.config["error_messages"].get("ambiguous_server", "Please add which server this is for at the end of the command, one of: ") + names)
+
+    # Returns the settings of every configured guild the user is a member of, looked up concurrently
+    async def get_member_guilds(self, user_id):
+        settings_list = self.guild_settings.all()
+        members = await asyncio.gather(*[self.members.get_member(settings["server_id"], user_id) for settings in settings_list])
+        return [settings for settings, member in zip(settings_list, members) if member is not None]
+
+    # Sets the nickname in every configured guild at once and returns the settings of the guilds the user is in
+    async def change_user_nicknames(self, user_id, nickname):
+        settings_list = self.guild_settings.all()
+        changed = await asyncio.gather(*[self.change_user_nickname(settings, user_id, nickname) for settings in settings_list])
+        return [settings for settings, is_member in zip(settings_list, changed) if is_member]
+
+    async def send_manual_review_post(self, ctx, settings, fflogs_url, role, name):
+        user = ctx.author
+        title = "Logs for Manual Review"
+        description = "These logs have been flagged for manual review. Please look through them an react accordingly."
+        username = user.display_name + " (" + user.name + "#" + user.discriminator + ")"
+
+        embed = discord.Embed(title=title, url=fflogs_url, description=description, color=0xf404ec)
+        embed.set_author(name=username, icon_url=user.avatar_url)
+        embed.set_thumbnail(url="https://assets.rpglogs.com/img/ff/header-logo.png?v=2")
+        embed.add_field(name="FFLogs Link", value=fflogs_url, inline=False)
+        embed.add_field(name="User ID", value=str(user.id), inline=True)
+        embed.add_field(name="Role Requested", value=role, inline=True)
+        embed.add_field(name="FFXIV Name", value=name, inline=False)
+
+        channel = await self.members.get_channel(settings["manual_review_channel_id"])
+        message = await self.outbound.send(channel, embed=embed, priority=REVIEW)
+        self.db.add_review(message.id, channel.id, user.id, fflogs_url, role, name)
+        self.outbound.add_reactions(message, [settings["accept_emoji"], settings["reject_emoji"]])
+
+    # Returns (status code, (report, fight, URL, data)) of a single fight, or of the best scoring fight of a whole report
+    async def fetch_drs_logs(self, ctx, policy, fflogs_url, name):
+        report_code = self.web.parse_fflogs_report_url(fflogs_url)
+        if report_code is None:
+            status_code, data = await self.fetcher.get_log_data(fflogs_url, name)
+            if status_code != self.config["error_codes"]["success"]:
+                return (status_code, data)
+            # Submissions, review posts and audit lines point to the resolved fight, since "fight=last" moves with every pull
+            report = self.web.parse_fflogs_url(fflogs_url)[0]
+            fight, data = data
+            if fight == "last":
+                return (status_code, (report, fight, fflogs_url, data))
+            return (status_code, (report, fight, self.web.get_fflogs_fight_url(report, fight), data))
+
+        status_code, logs = await self.fetcher.get_report_log_data(report_code, name, policy.get_bosses())
+        if status_code != self.config["error_codes"]["success"]:
+            return (status_code, logs)
+        fight, data, score = policy.select_best_drs_logs(logs)
+        fight_url = self.web.get_fflogs_fight_url(report_code, fight)
+        count("report_checks", "fights", len(logs))
+        if len(logs) > 1:
+            await self.outbound.reply(ctx, "Checked " + str(len(logs)) + " fights of your report, fight " + fight + " scored best: " + fight_url)
+        return (status_code, (report_code, fight, fight_url, data))
+
+    async def process_drs_logs(self, ctx, settings, role, fflogs_url, user):
+        config = self.config
+        policy = self.guild_settings.get_policy(settings["server_id"])
+
+        # Parse HTML of Logs
+        with timer("log_fetch"):
+            status_code, data = await self.fetch_drs_logs(ctx, policy, fflogs_url, str(user[NAME]))
+        if status_code == config["error_codes"]["failure"]:
+            count("log_checks", get_failure_reason(data))
+            await self.outbound.reply(ctx, data)
+        elif status_code == config["error_codes"]["success"]:
+            report, fight, fight_url, data = data
+            fight_key = self.web.parse_fflogs_url(fflogs_url)
+            if fight_key is not None and fight_key[1] == "last" and self.is_already_rejected(settings, user[ID], report, fight):
+                count("log_checks", "already_rejected")
+                await self.outbound.reply(ctx, config["error_messages"].get("log_already_rejected", "These logs have already been checked and were rejected. Please provide other logs."))
+                return
+            # Check Logs According to Policy
+            with timer("policy_check"):
+                status_code, log_accepted = policy.check_drs_logs(data)
+            count("log_checks", self.record_submission(policy, user, report, fight, role, data))
+            if status_code == config["error_codes"]["failure"]:
+                await self.outbound.reply(ctx, log_accepted)
+            elif status_code == config["error_codes"]["manual_check"]:
+                await self.outbound.reply(ctx, log_accepted)
+                await self.send_manual_review_post(ctx, settings, fight_url, role, user[NAME])
+            elif status_code == config["error_codes"]["success"]:
+                discord_user = ctx.message.author
+                if log_accepted is True:
+                    await self.outbound.reply(ctx, config["error_messages"]["log_accepted"])
+                    await self.add_requested_role(settings, discord_user, role)
+                    self.log_message(settings, "Accepted DRS logs (" + fight_url + ") for " + discord_user.name + "#" + discord_user.discriminator)
+                else:
+                    await self.outbound.reply(ctx, config["error_messages"]["log_rejected"])
+                    self.log_message(settings, "Rejected DRS logs (" + fight_url + ") for " + discord_user.name + "#" + discord_user.discriminator)
+
+    # Judged by the thresholds of this guild, since another guild may have rejected logs this one accepts
+    def is_already_rejected(self, settings, user_id, report, fight):
+        previous = self.db.get_report_verdict(user_id, report, fight)
+        return previous is not None and self.guild_settings.get_policy(settings["server_id"]).get_verdict(previous[1]) == REJECTED
+
+    def record_submission(self, policy, user, report, fight, role, data):
+        score = policy.score_drs_logs(data)
+        verdict = policy.get_verdict(score)
+        self.db.add_submission(user[ID], user[NAME], report, fight, role, data, verdict, score)
+        return verdict
+
+    def get_info_message(self, settings):
+        return '\n'.join(settings["info_message"])
+
+    async def on_character_changed(self, user_id, old_name, name, world):
+        for settings in await self.change_user_nicknames(user_id, name + " [" + world + "]"):
+            self.log_message(settings, "Lodestone character of <@" + str(user_id) + "> changed from " + str(old_name) + " to " + name + " [" + world + "]")
+
+    async def add_requested_role(self, settings, user, role_name):
+        if role_name in settings["roles"]:
+            member = await self.members.get_member(settings["server_id"], user.id)
+            if member is None:
+                print("User", user.id, "is not a member of the server", settings["server_id"])
+                return
+            role = member.guild.get_role(settings["roles"][role_name])
+            with timer("discord_add_roles"):
+                await member.add_roles(role)
+            self.members.invalidate_member(settings["server_id"], user.id)
+        else:
+            print("No Role ID for", role_name, "found!")
+
+    # Returns False if the user is not a member of the guild
+    async def change_user_nickname(self, settings, user, nickname):
+        member = await self.members.get_member(settings["server_id"], user)
+        if member is None:
+            return False
+        with timer("discord_edit_member"):
+            await member.edit(nick=nickname)
+        self.members.invalidate_member(settings["server_id"], user)
+        return True
+
+    async def user_has_role(self, settings, user_id, role_id):
+        member = await self.members.get_member(settings["server_id"], user_id)
+        if member is None:
+            return False
+        for role in member.roles:
+            if role.id == role_id:
+                return True
+        return False
+
+    # ----------------------------------------------------------------------
+    # Bot Events
+    # ----------------------------------------------------------------------
+    async def on_raw_reaction_add(self, payload):
+        # Raw reaction events also fire for review posts from before a restart, which are not in the message cache
+        settings = self.guild_settings.get(payload.guild_id)
+        if settings is None or payload.channel_id != settings["manual_review_channel_id"]:
+            return
+        emoji = str(payload.emoji)
+        if emoji == settings["accept_emoji"]:
+            status = "accepted"
+        elif emoji == settings["reject_emoji"]:
+            status = "rejected"
+        else:
+            return
+
+        review = self.db.get_review(payload.message_id)
+        if review is None:
+            review = await self.import_review_post(payload.channel_id, payload.message_id)
+        if review is None or review[6] != "pending":
+            return
+        reviewer = payload.member
+        if reviewer is None:
+            reviewer = await self.members.get_member(settings["server_id"], payload.user_id)
+        if reviewer is None or reviewer.bot:
+            return
+        if not self.db.resolve_review(payload.message_id, reviewer.id, status):
+            return
+
+        message_id, channel_id, user_id, fflogs_url, role_requested = review[:5]
+        user_to_dm = await self.members.get_user(user_id)
+        if status == "accepted":
+            reply = "The logs you provided (" + fflogs_url + ") has been manually reviewed and accepted by " + reviewer.display_name + "!\n"
+            reply += settings.get("review_accepted_message", "To join our next DRS run, head to https://discord.com/channels/806471097108267028/853202849894629376/ and react accordingly.")
+            await self.outbound.reply(user_to_dm, reply)
+            await self.add_requested_role(settings, user_to_dm, role_requested)
+            self.log_message(settings, reviewer.display_name + " manually accepted DRS logs (" + fflogs_url + ") for " + user_to_dm.name + "#" + user_to_dm.discriminator)
+        else:
+            await self.outbound.reply(user_to_dm, "The logs you provided (" + fflogs_url + ") has been manually reviewed and rejected.\nPlease contact " + reviewer.display_name + " for more details.")
+            self.log_message(settings, reviewer.display_name + " manually rejected DRS logs (" + fflogs_url + ") for " + user_to_dm.name + "#" + user_to_dm.discriminator)
+
+        channel = self.get_channel(channel_id)
+        if channel is not None:
+            review_post = channel.get_partial_message(message_id)
+            self.outbound.enqueue(REVIEW, channel, review_post.delete)
+
+    # Review posts from before reviews were stored have no row, so one is recorded from the embed of the post
+    async def import_review_post(self, channel_id, message_id):
+        try:
+            channel = await self.members.get_channel(channel_id)
+            with timer("discord_fetch_message"):
+                message = await channel.fetch_message(message_id)
+        except discord.HTTPException:
+            return None
+        if message.author.id != self.user.id or len(message.embeds) == 0:
+            return None
+
+        fields = {field.name: field.value for field in message.embeds[0].fields}
+        if "FFLogs Link" not in fields or "User ID" not in fields or "Role Requested" not in fields:
+            return None
+        self.db.add_review(message.id, channel_id, int(fields["User ID"]), fields["FFLogs Link"], fields["Role Requested"], fields.get("FFXIV Name", ""))
+        count("reviews", "imported")
+        return self.db.get_review(message.id)
+
+    async def on_member_update(self, before, after):
+        self.members.invalidate_member(after.guild.id, after.id)
+
+    async def on_member_remove(self, member):
+        self.members.invalidate_member(member.guild.id, member.id)
+
+    async def on_guild_role_update(self, before, after):
+        self.members.invalidate_guild(after.guild.id)
+
+    async def on_guild_role_delete(self, role):
+        self.members.invalidate_guild(role.guild.id)
+
+    async def on_member_join(self, member):
+        self.members.invalidate_member(member.guild.id, member.id)
+        settings = self.guild_settings.get(member.guild.id)
+        if settings is None:
+            return
+        # One combined DM per joiner keeps join waves within the rate limits
+        note = "**Note:** If you are not interested in running this content with us you can ignore this message."
+        self.outbound.send(member, self.get_info_message(settings) + "\n\n" + note)
+
+    async def on_ready(self):
+        print("Running.")
+        await self.metrics_server.start()
+        # Only the process handling the commands checks logs and sweeps the profiles
+        if self.handles_direct_messages():
+            self.fetcher.start()
+            self.reverify.start()
+        await self.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name="all the logs - Rawr!"))
 
 # ----------------------------------------------------------------------
 # Command Checks
@@ -29,196 +321,158 @@ policy = Policy(config)
 def is_dm_channel(ctx):
     return isinstance(ctx.channel, discord.channel.DMChannel)
 
+# Staff of any served guild may use the staff commands
+async def is_staff(ctx):
+    bot = ctx.bot
+    for settings in bot.guild_settings.all():
+        if "staff_role_id" in settings and await bot.user_has_role(settings, ctx.message.author.id, settings["staff_role_id"]):
+            return True
+    return False
+
 async def is_user_verified(ctx):
-    user = db.create_or_get_user(ctx.message.author.id)
+    bot = ctx.bot
+    user = bot.db.create_or_get_user(ctx.message.author.id)
     if user[VALIDATED] != 1:
-        await ctx.send(config["error_messages"]["user_not_verified"])
+        await bot.outbound.reply(ctx, bot.config["error_messages"]["user_not_verified"])
         return False
     else:
         return True
 
-async def log_message(msg):
-    channel = bot.get_channel(config["logging_channel_id"])
-    await channel.send(msg)
-
-# ----------------------------------------------------------------------
-# Subroutines 
-# ----------------------------------------------------------------------
-async def send_manual_review_post(ctx, fflogs_url, role, name):
-    user = ctx.author
-    title = "Logs for Manual Review"
-    description = "These logs have been flagged for manual review. Please look through them an react accordingly."
-    username = user.display_name + " (" + user.name + "#" + user.discriminator + ")"
-
-    embed = discord.Embed(title=title, url=fflogs_url, description=description, color=0xf404ec)
-    embed.set_author(name=username, icon_url=user.avatar_url)
-    embed.set_thumbnail(url="https://assets.rpglogs.com/img/ff/header-logo.png?v=2")
-    embed.add_field(name="FFLogs Link", value=fflogs_url, inline=False)
-    embed.add_field(name="User ID", value=str(user.id), inline=True)
-    embed.add_field(name="Role Requested", value=role, inline=True)
-    embed.add_field(name="FFXIV Name", value=name, inline=False)
-
-    channel = bot.get_channel(config["manual_review_channel_id"])
-    message = await channel.send(embed=embed)
-    await message.add_reaction(config["accept_emoji"])
-    await message.add_reaction(config["reject_emoji"])
-
-async def send_info_message(ctx):
-    compiled_message = '\n'.join(config["info_message"])
-    await ctx.send(compiled_message)
-
-async def add_requested_role(user, role_name):
-    guild = await bot.fetch_guild(config["server_id"])
-    if role_name in config["roles"]:
-        role = guild.get_role(config["roles"][role_name])
-        member = await guild.fetch_member(user.id)
-        await member.add_roles(role)
-    else:
-        print("No Role ID for", role_name, "found!")
-
-async def change_user_nickname(user, nickname):
-    guild = await bot.fetch_guild(config["server_id"])
-    member = await guild.fetch_member(user)
-    await member.edit(nick=nickname)
-
-async def user_has_role(user_id, role_id):
-    guild = await bot.fetch_guild(config["server_id"])
-    member = await guild.fetch_member(user_id)
-    for role in member.roles:
-        if role.id == role_id:
-            return True
-    return False
-
-# ----------------------------------------------------------------------
-# Bot Events
-# ----------------------------------------------------------------------
-@bot.event
-async def on_reaction_add(reaction, user):
-    if reaction.message.channel.id == config["manual_review_channel_id"]:
-        if user.bot:
-            return
-
-        if len(reaction.message.embeds) > 0:
-            embed = reaction.message.embeds[0]
-            user_id = int(embed.fields[1].value)
-            user_to_dm = await bot.fetch_user(user_id)
-            fflogs_url = embed.fields[0].value
-            role_requested = embed.fields[2].value
-
-            if reaction.emoji == config["accept_emoji"]:
-                reply = "The logs you provided (" + fflogs_url + ") has been manually reviewed and accepted by " + user.display_name + "!\n"
-                reply += "To join our next DRS run, head to https://discord.com/channels/806471097108267028/853202849894629376/ and react accordingly."
-                await user_to_dm.send(reply)
-                await add_requested_role(user_to_dm, role_requested)
-                await log_message(user.display_name + " manually accepted DRS logs (" + fflogs_url + ") for " + user_to_dm.name + "#" + user_to_dm.discriminator)
-            elif reaction.emoji == config["reject_emoji"]:
-                await user_to_dm.send("The logs you provided (" + fflogs_url + ") has been manually reviewed and rejected.\nPlease contact " + user.display_name + " for more details.")
-                await log_message(user.display_name + " manually rejected DRS logs (" + fflogs_url + ") for " + user_to_dm.name + "#" + user_to_dm.discriminator)
-
-            await reaction.message.delete()
-
-@bot.event
-async def on_member_join(member):
-    await send_info_message(member)
-    await member.send("**Note:** If you are not interested in running this content with us you can ignore this message.")
-
-@bot.event
-async def on_ready():
-    print("Running.")
-    await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name="all the logs - Rawr!"))
-
 # ----------------------------------------------------------------------
 # Bot Commands
 # ----------------------------------------------------------------------
-@bot.command()
+@commands.command()
 @commands.check(is_dm_channel)
 @commands.check(is_user_verified)
-async def role(ctx, role, fflogs_url):
-    user = db.create_or_get_user(ctx.message.author.id)
+async def role(ctx, role, fflogs_url, server=None):
+    bot = ctx.bot
+    config = bot.config
+    user = bot.db.create_or_get_user(ctx.message.author.id)
 
     if role == "drs":
-        if await user_has_role(user[ID], config["roles"][role]):
-            await ctx.send("You already have the DRS role!")
+        status_code, settings = await bot.get_command_guild(ctx, server)
+        if status_code == config["error_codes"]["failure"]:
+            await bot.outbound.reply(ctx, settings)
             return
-        # Parse HTML of Logs
-        await ctx.send("Checking provided logs.\nThis may take some seconds.")
-        status_code, data = web.get_log_data(fflogs_url, str(user[NAME]))
+        if await bot.user_has_role(settings, user[ID], settings["roles"][role]):
+            await bot.outbound.reply(ctx, "You already have the DRS role!")
+            return
+        # Mistyped links are turned away before they use up the submission cooldown
+        fight_key = bot.web.parse_fflogs_url(fflogs_url)
+        if fight_key is None and bot.web.parse_fflogs_report_url(fflogs_url) is None:
+            await bot.outbound.reply(ctx, config["error_messages"]["invalid_logs_url"])
+            return
+        # Logs which have already been rejected do not need to be checked again, "fight=last" is checked once it is resolved
+        if fight_key is not None and fight_key[1] != "last" and bot.is_already_rejected(settings, user[ID], fight_key[0], fight_key[1]):
+            await bot.outbound.reply(ctx, config["error_messages"].get("log_already_rejected", "These logs have already been checked and were rejected. Please provide other logs."))
+            return
+        # Queue the Log Check
+        status_code, data = bot.log_queue.submit(user[ID], lambda: bot.process_drs_logs(ctx, settings, role, fflogs_url, user))
         if status_code == config["error_codes"]["failure"]:
-            await ctx.send(data)
-        elif status_code == config["error_codes"]["success"]:
-            # Check Logs According to Policy
-            status_code, log_accepted = policy.check_drs_logs(data)
-            if status_code == config["error_codes"]["failure"]:
-                await ctx.send(log_accepted)
-            elif status_code == config["error_codes"]["manual_check"]:
-                await ctx.send(log_accepted)
-                await send_manual_review_post(ctx, fflogs_url, role, user[NAME])
-            elif status_code == config["error_codes"]["success"]:
-                discord_user = ctx.message.author
-                if log_accepted is True:
-                    await ctx.send(config["error_messages"]["log_accepted"])
-                    await add_requested_role(discord_user, role)
-                    await log_message("Accepted DRS logs (" + fflogs_url + ") for " + discord_user.name + "#" + discord_user.discriminator)
-                else:
-                    await ctx.send(config["error_messages"]["log_rejected"])
-                    await log_message("Rejected DRS logs (" + fflogs_url + ") for " + discord_user.name + "#" + discord_user.discriminator)
+            await bot.outbound.reply(ctx, data)
+            return
+        position, wait = data
+        await bot.outbound.reply(ctx, "Checking provided logs.\nYou are number " + str(position) + " in the queue, this may take about " + str(wait) + " seconds.")
 
-@bot.command()
+@commands.command()
 @commands.check(is_dm_channel)
 async def verify(ctx, *args):
-    user = db.create_or_get_user(ctx.message.author.id)
-    if user[VALIDATED] == 1:
+    bot = ctx.bot
+    config = bot.config
+    user = bot.db.create_or_get_user(ctx.message.author.id)
+    # Users validated before profiles were stored can verify again, which links their profile for re-verification
+    if user[VALIDATED] == 1 and bot.db.has_lodestone_profile(user[ID]):
         reply = config["error_messages"]["user_already_validated"] + str(user[NAME])
-        await ctx.send(reply)
+        await bot.outbound.reply(ctx, reply)
         return
 
     # Verify Challenge-Response Token
     if len(args) == 1:
-        status_code, data = web.get_lodestone_data(args[0])
+        status_code, data = await bot.fetcher.get_lodestone_data(args[0])
         if status_code == config["error_codes"]["failure"]:
-            await ctx.send(data)
+            await bot.outbound.reply(ctx, data)
         elif status_code == config["error_codes"]["success"]:
             lodestone_name = data[0]
             token = data[1]
             lodestone_world = data[2]
-            if user[TOKEN] in token:
-                db.set_user_validation(user[ID], 1)
-                db.set_user_name(user[ID], lodestone_name)
-                db.set_user_token(user[ID], "")
+            # Validated users have their token cleared, so an empty token must never match
+            if user[TOKEN] and user[TOKEN] in token:
+                bot.db.verify_user(user[ID], lodestone_name, args[0], lodestone_world)
                 reply = config["error_messages"]["validation_success"] + lodestone_name + "\n"
                 reply += "We recommend you to remove the token from your lodestone character profile now."
-                await change_user_nickname(user[ID], lodestone_name + " [" + lodestone_world + "]")
-                await ctx.send(reply)
+                await bot.change_user_nicknames(user[ID], lodestone_name + " [" + lodestone_world + "]")
+                await bot.outbound.reply(ctx, reply)
             else:
-                await ctx.send(config["error_messages"]["invalid_token"])
+                await bot.outbound.reply(ctx, config["error_messages"]["invalid_token"])
 
     # Generate Challenge-Response Token
     else:
         id_string = str(user[ID]).encode("utf-8")
-        sha3.update(id_string)
-        id_hash = sha3.hexdigest()
+        bot.sha3.update(id_string)
+        id_hash = bot.sha3.hexdigest()
         random = os.urandom(16).hex()
         token = id_hash + "-" + random
-        db.set_user_token(user[ID], token)
-        await ctx.send(config["error_messages"]["validation_token"] + str(token))
-        await ctx.send("Put this on your lodestone character profile and use the command !verify [lodestone URL].")
+        bot.db.set_user_token(user[ID], token)
+        await bot.outbound.reply(ctx, config["error_messages"]["validation_token"] + str(token))
+        await bot.outbound.reply(ctx, "Put this on your lodestone character profile and use the command !verify [lodestone URL].")
+
+@commands.command()
+@commands.check(is_dm_channel)
+@commands.check(is_staff)
+async def stats(ctx):
+    bot = ctx.bot
+    summary = registry.render_summary()[:1850] + "\n\nPending reviews: " + str(bot.db.count_pending_reviews())
+    await bot.outbound.reply(ctx, "```\n" + summary + "\n```")
 
-@bot.command()
+@commands.command()
 @commands.check(is_dm_channel)
-async def info(ctx):
-    await send_info_message(ctx)
+async def info(ctx, server=None):
+    bot = ctx.bot
+    status_code, settings = await bot.get_command_guild(ctx, server)
+    if status_code == bot.config["error_codes"]["failure"]:
+        await bot.outbound.reply(ctx, settings)
+        return
+    await bot.outbound.reply(ctx, bot.get_info_message(settings))
 
-@bot.command()
+@commands.command()
 @commands.check(is_dm_channel)
 async def help(ctx):
     reply = "You can use the following commands (all commands must be used over DM):\n"
     reply += "!verify: generates a token for you to put on your lodestone profile.\n"
     reply += "!verify [lodestone URL]: verifies your token in order to confirm your FFXIV identity.\n"
     reply += "!role drs [fflogs URL]: checks your provided DRS logs.\n"
-    await ctx.send(reply)
+    reply += "!role drs [fflogs report URL]: checks every DRS fight of a report without #fight= and keeps the best one.\n"
+    if len(ctx.bot.guild_settings.all()) > 1:
+        reply += "If you are in several servers using this bot, add the server name at the end of !role and !info.\n"
+    await ctx.bot.outbound.reply(ctx, reply)
 
 # ----------------------------------------------------------------------
-# Run Bot
+# Application Factory
 # ----------------------------------------------------------------------
-bot.run(config["token"])
+def create_bot(config, shard_ids=None, shard_count=None):
+    bot = Cerberus(config, shard_ids, shard_count)
+    for command in [role, verify, stats, info, help]:
+        bot.add_command(command)
+    return bot
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the Cerberus bot.")
+    parser.add_argument("--config", default="config.json", help="Path of the config file")
+    parser.add_argument("--shard-count", type=int, help="Total number of shards over all processes")
+    parser.add_argument("--shard-ids", type=int, nargs="+", help="Shards run by this process, all of them when omitted")
+    parser.add_argument("--metrics-port", type=int, help="Overrides metrics_port, each process needs its own")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if args.metrics_port is not None:
+        config["metrics_port"] = args.metrics_port
+    shard_count = args.shard_count if args.shard_count is not None else config.get("shard_count")
+    shard_ids = args.shard_ids if args.shard_ids is not None else config.get("shard_ids")
+    if shard_ids is not None and shard_count is None:
+        parser.error("--shard-ids requires --shard-count")
+
+    bot = create_bot(config, shard_ids, shard_count)
+    bot.run(config["token"])
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import threading
+import time
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver import FirefoxOptions
+from metrics import timed
+
+class BrowserPoolTimeout(Exception):
+    pass
+
+"""
+A single long-lived headless Firefox and the number of pages it has rendered.
+
+"""
+class BrowserSession():
+    def __init__(self, driver):
+        self.driver = driver
+        self.pages = 0
+
+"""
+Keeps a bounded set of headless Firefox sessions alive between log checks.
+
+Browsers are launched lazily up to the pool size, health checked on checkout
+and recycled after a configurable number of pages or whenever they crash.
+
+"""
+class BrowserPool():
+    def __init__(self, config):
+        self.gecko_driver_path = config["gecko_driver_path"]
+        self.size = config.get("browser_pool_size", 2)
+        self.max_pages = config.get("browser_max_pages", 50)
+        self.checkout_timeout = config.get("browser_checkout_timeout", 60)
+        self.page_load_timeout = config.get("browser_page_load_timeout", 30)
+        self.condition = threading.Condition()
+        self.idle = []
+        self.created = 0
+        self.closed = False
+
+    # Borrows a browser, waiting up to timeout seconds for one to become available
+    def checkout(self, timeout=None):
+        if timeout is None:
+            timeout = self.checkout_timeout
+        deadline = time.monotonic() + timeout
+
+        while True:
+            session = None
+            with self.condition:
+                while True:
+                    if self.closed:
+                        raise BrowserPoolTimeout("Browser pool is closed")
+                    if len(self.idle) > 0:
+                        session = self.idle.pop()
+                        break
+                    if self.created < self.size:
+                        self.created += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise BrowserPoolTimeout("No browser became available within " + str(timeout) + " seconds")
+                    self.condition.wait(remaining)
+
+            # Launch a new browser outside of the lock since startup takes seconds
+            if session is None:
+                try:
+                    return self.launch()
+                except Exception:
+                    self.release_slot()
+                    raise
+
+            if self.is_healthy(session):
+                return session
+            self.discard(session)
+
+    # Returns a browser to the pool, or throws it away if it crashed or is worn out
+    def checkin(self, session, broken=False, pages=1):
+        if not broken:
+            session.pages += pages
+            if session.pages >= self.max_pages:
+                broken = True
+
+        # Leave the previous report so the next navigation always triggers a full page load
+        if not broken:
+            try:
+                session.driver.get("about:blank")
+            except WebDriverException:
+                broken = True
+
+        if broken:
+            self.discard(session)
+            return
+
+        with self.condition:
+            if self.closed:
+                self.quit_driver(session)
+                self.created -= 1
+            else:
+                self.idle.append(session)
+            self.condition.notify()
+
+    @timed("browser_launch")
+    def launch(self):
+        opts = FirefoxOptions()
+        opts.add_argument("--headless")
+        driver = webdriver.Firefox(executable_path=self.gecko_driver_path, firefox_options=opts)
+        driver.set_page_load_timeout(self.page_load_timeout)
+        return BrowserSession(driver)
+
+    def is_healthy(self, session):
+        try:
+            session.driver.current_url
+            return True
+        except WebDriverException:
+            return False
+
+    def discard(self, session):
+        self.quit_driver(session)
+        self.release_slot()
+
+    def release_slot(self):
+        with self.condition:
+            self.created -= 1
+            self.condition.notify()
+
+    def quit_driver(self, session):
+        try:
+            session.driver.quit()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            sessions = self.idle
+            self.idle = []
+            self.created -= len(sessions)
+            self.condition.notify_all()
+        for session in sessions:
+            self.quit_driver(session)
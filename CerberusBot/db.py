@@ -1,8 +1,20 @@
 import sqlite3
+import time
+from collections import OrderedDict
+from metrics import timed
+
+# User Row Indices
+ID = 0
+VALIDATED = 1
+NAME = 2
+TOKEN = 3
 
 class DB:
-    def __init__(self, db_name):
+    def __init__(self, db_name, user_cache_size=1024):
         self.conn = sqlite3.connect(db_name)
+        # WAL lets readers run alongside the writer and only fsyncs on checkpoints
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('PRAGMA synchronous=NORMAL;')
         cursor = self.conn.cursor()
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS users(
@@ -12,52 +24,412 @@ class DB:
             TOKEN TEXT
         );
         ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS log_cache(
+            REPORT TEXT NOT NULL,
+            FIGHT TEXT NOT NULL,
+            EXPIRES REAL NOT NULL,
+            DATA TEXT NOT NULL,
+            PRIMARY KEY(REPORT, FIGHT)
+        );
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS submissions(
+            ID INTEGER PRIMARY KEY AUTOINCREMENT,
+            USER_ID INTEGER NOT NULL,
+            REPORT TEXT NOT NULL,
+            FIGHT TEXT NOT NULL,
+            ROLE TEXT,
+            BOSS TEXT,
+            KILL_STATUS TEXT,
+            FIGHT_TIME INTEGER,
+            VERDICT TEXT,
+            SCORE REAL,
+            CREATED REAL NOT NULL
+        );
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fight_stats(
+            SUBMISSION_ID INTEGER NOT NULL REFERENCES submissions(ID),
+            PLAYER TEXT NOT NULL,
+            DAMAGE REAL,
+            HEALING REAL,
+            PRIMARY KEY(SUBMISSION_ID, PLAYER)
+        );
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS deaths(
+            SUBMISSION_ID INTEGER NOT NULL REFERENCES submissions(ID),
+            PLAYER TEXT NOT NULL,
+            TIME INTEGER,
+            MECHANIC TEXT
+        );
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reviews(
+            MESSAGE_ID INTEGER PRIMARY KEY NOT NULL,
+            CHANNEL_ID INTEGER NOT NULL,
+            USER_ID INTEGER NOT NULL,
+            FFLOGS_URL TEXT NOT NULL,
+            ROLE TEXT NOT NULL,
+            NAME TEXT,
+            STATUS TEXT NOT NULL DEFAULT 'pending',
+            REVIEWER_ID INTEGER,
+            CREATED REAL NOT NULL,
+            RESOLVED REAL
+        );
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lodestone_profiles(
+            USER_ID INTEGER PRIMARY KEY NOT NULL REFERENCES users(ID),
+            URL TEXT NOT NULL,
+            WORLD TEXT,
+            ETAG TEXT,
+            LAST_MODIFIED TEXT,
+            CHECKED REAL
+        );
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS submissions_user ON submissions(USER_ID, CREATED);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS submissions_report ON submissions(REPORT, FIGHT, USER_ID);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS submissions_boss ON submissions(BOSS, CREATED);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS submissions_created ON submissions(CREATED);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS deaths_submission ON deaths(SUBMISSION_ID);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS reviews_pending ON reviews(STATUS, CREATED);')
         cursor.close()
         self.conn.commit()
 
+        # Write-through cache of user rows, so checks and commands share one lookup
+        self.user_cache = OrderedDict()
+        self.user_cache_size = user_cache_size
+
+    @timed("db_users")
     def create_or_get_user(self, discord_id):
-        user = self.get_user(discord_id)
-        if user is None:
-            self.create_user(discord_id)
-            return self.get_user(discord_id)
-        else:
+        user = self.get_cached_user(discord_id)
+        if user is not None:
             return user
 
+        cursor = self.conn.cursor()
+        query = '''
+        INSERT INTO users(ID) VALUES(?)
+        ON CONFLICT(ID) DO UPDATE SET ID = excluded.ID
+        RETURNING ID, VALIDATED, NAME, TOKEN;
+        '''
+        cursor.execute(query, (int(discord_id),))
+        user = cursor.fetchone()
+        cursor.close()
+        self.conn.commit()
+        self.cache_user(user)
+        return user
+
+    @timed("db_users")
     def create_user(self, discord_id):
         cursor = self.conn.cursor()
         query = 'INSERT INTO users(id) VALUES(?);'
         cursor.execute(query, (str(discord_id),))
         self.conn.commit()
         cursor.close()
+        self.cache_user((int(discord_id), 0, None, None))
 
+    @timed("db_users")
     def get_user(self, discord_id):
+        user = self.get_cached_user(discord_id)
+        if user is not None:
+            return user
+
         cursor = self.conn.cursor()
-        query = 'SELECT * FROM users WHERE id = ?;'
+        query = 'SELECT ID, VALIDATED, NAME, TOKEN FROM users WHERE id = ?;'
         cursor.execute(query, (str(discord_id),))
         row = cursor.fetchone()
         cursor.close()
+        if row is not None:
+            self.cache_user(row)
         return row
 
+    @timed("db_users")
     def set_user_token(self, discord_id, token):
         cursor = self.conn.cursor()
         query = 'UPDATE users SET TOKEN = ? WHERE id = ?;'
         cursor.execute(query, (str(token), str(discord_id)))
         self.conn.commit()
         cursor.close()
+        self.update_cached_user(discord_id, TOKEN, str(token))
 
+    @timed("db_users")
     def set_user_name(self, discord_id, name):
         cursor = self.conn.cursor()
         query = 'UPDATE users SET NAME = ? WHERE id = ?;'
         cursor.execute(query, (str(name), str(discord_id)))
         self.conn.commit()
         cursor.close()
+        self.update_cached_user(discord_id, NAME, str(name))
 
+    @timed("db_users")
     def set_user_validation(self, discord_id, validated):
         cursor = self.conn.cursor()
         query = 'UPDATE users SET VALIDATED = ? WHERE id = ?;'
         cursor.execute(query, (validated, str(discord_id)))
         self.conn.commit()
         cursor.close()
+        self.update_cached_user(discord_id, VALIDATED, validated)
+
+    # Marks a user as validated under their character name and clears the token in one transaction
+    @timed("db_users")
+    def verify_user(self, discord_id, name, lodestone_url=None, world=None):
+        cursor = self.conn.cursor()
+        query = 'UPDATE users SET VALIDATED = 1, NAME = ?, TOKEN = ? WHERE id = ?;'
+        cursor.execute(query, (str(name), "", str(discord_id)))
+        # Remember the profile so the character can be re-verified later
+        if lodestone_url is not None:
+            query = 'INSERT OR REPLACE INTO lodestone_profiles(USER_ID, URL, WORLD, CHECKED) VALUES(?, ?, ?, ?);'
+            cursor.execute(query, (int(discord_id), lodestone_url, world, time.time()))
+        self.conn.commit()
+        cursor.close()
+        user = self.get_cached_user(discord_id)
+        if user is not None:
+            self.cache_user((user[ID], 1, str(name), ""))
+
+    def get_cached_user(self, discord_id):
+        key = int(discord_id)
+        user = self.user_cache.get(key)
+        if user is not None:
+            self.user_cache.move_to_end(key)
+        return user
+
+    def cache_user(self, user):
+        self.user_cache[user[ID]] = user
+        self.user_cache.move_to_end(user[ID])
+        while len(self.user_cache) > self.user_cache_size:
+            self.user_cache.popitem(last=False)
+
+    def update_cached_user(self, discord_id, index, value):
+        user = self.get_cached_user(discord_id)
+        if user is not None:
+            user = list(user)
+            user[index] = value
+            self.cache_user(tuple(user))
+
+    @timed("db_log_cache")
+    def get_cached_fight(self, report, fight, now):
+        cursor = self.conn.cursor()
+        query = 'SELECT EXPIRES, DATA FROM log_cache WHERE REPORT = ? AND FIGHT = ? AND EXPIRES > ?;'
+        cursor.execute(query, (report, fight, now))
+        row = cursor.fetchone()
+        cursor.close()
+        return row
+
+    @timed("db_log_cache")
+    def set_cached_fight(self, report, fight, expires, data):
+        cursor = self.conn.cursor()
+        query = 'INSERT OR REPLACE INTO log_cache(REPORT, FIGHT, EXPIRES, DATA) VALUES(?, ?, ?, ?);'
+        cursor.execute(query, (report, fight, expires, data))
+        self.conn.commit()
+        cursor.close()
+
+    def delete_expired_fights(self, now):
+        cursor = self.conn.cursor()
+        query = 'DELETE FROM log_cache WHERE EXPIRES <= ?;'
+        cursor.execute(query, (now,))
+        self.conn.commit()
+        cursor.close()
+
+    # Stores a parsed log and its verdict, returning the submission ID
+    def add_submission(self, user_id, player, report, fight, role, data, verdict, score, created=None):
+        return self.add_submissions([(user_id, player, report, fight, role, data, verdict, score, created)])[0]
+
+    # Stores many (user ID, player, report, fight, role, parsed log, verdict, score, created) rows in one transaction
+    @timed("db_submissions")
+    def add_submissions(self, submissions):
+        ids = []
+        cursor = self.conn.cursor()
+        for user_id, player, report, fight, role, data, verdict, score, created in submissions:
+            boss_name, fight_metadata, dmg_done, heal_done, deaths = data
+            if created is None:
+                created = time.time()
+
+            query = '''
+            INSERT INTO submissions(USER_ID, REPORT, FIGHT, ROLE, BOSS, KILL_STATUS, FIGHT_TIME, VERDICT, SCORE, CREATED)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+            '''
+            cursor.execute(query, (int(user_id), report, str(fight), role, boss_name, fight_metadata[0], fight_metadata[1], verdict, score, created))
+            submission_id = cursor.lastrowid
+
+            query = 'INSERT INTO fight_stats(SUBMISSION_ID, PLAYER, DAMAGE, HEALING) VALUES(?, ?, ?, ?);'
+            cursor.execute(query, (submission_id, str(player), dmg_done, heal_done))
+            query = 'INSERT INTO deaths(SUBMISSION_ID, PLAYER, TIME, MECHANIC) VALUES(?, ?, ?, ?);'
+            cursor.executemany(query, [(submission_id, str(player), death[0], death[1]) for death in deaths])
+            ids.append(submission_id)
+        self.conn.commit()
+        cursor.close()
+        return ids
+
+    # Streams (submission row, parsed log) pairs matching the filters, oldest first
+    def iter_submissions(self, user_id=None, report=None, boss=None, since=None, batch_size=500):
+        conditions = []
+        params = []
+        if user_id is not None:
+            conditions.append('s.USER_ID = ?')
+            params.append(int(user_id))
+        if report is not None:
+            conditions.append('s.REPORT = ?')
+            params.append(report)
+        if boss is not None:
+            conditions.append('s.BOSS = ?')
+            params.append(boss)
+        if since is not None:
+            conditions.append('s.CREATED >= ?')
+            params.append(since)
+
+        query = '''
+        SELECT s.ID, s.USER_ID, s.REPORT, s.FIGHT, s.ROLE, s.BOSS, s.KILL_STATUS, s.FIGHT_TIME,
+               s.VERDICT, s.SCORE, s.CREATED, f.PLAYER, f.DAMAGE, f.HEALING
+        FROM submissions s JOIN fight_stats f ON f.SUBMISSION_ID = s.ID
+        '''
+        if len(conditions) > 0:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY s.ID;'
+
+        cursor = self.conn.cursor()
+        cursor.execute(query, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+
+                # Load the deaths of the whole batch at once
+                deaths = {}
+                death_cursor = self.conn.cursor()
+                placeholders = ', '.join('?' for row in rows)
+                death_query = 'SELECT SUBMISSION_ID, TIME, MECHANIC FROM deaths WHERE SUBMISSION_ID IN (' + placeholders + ') ORDER BY rowid;'
+                for submission_id, death_time, death_mechanic in death_cursor.execute(death_query, [row[0] for row in rows]):
+                    deaths.setdefault(submission_id, []).append((death_time, death_mechanic))
+                death_cursor.close()
+
+                for row in rows:
+                    data = (row[5], [row[6], row[7]], row[12], row[13], deaths.get(row[0], []))
+                    yield (row[:11], data)
+        finally:
+            cursor.close()
+
+    # Returns the most recent (verdict, score, created) for a user's report and fight, or None
+    @timed("db_submissions")
+    def get_report_verdict(self, user_id, report, fight):
+        cursor = self.conn.cursor()
+        query = '''
+        SELECT VERDICT, SCORE, CREATED FROM submissions
+        WHERE REPORT = ? AND FIGHT = ? AND USER_ID = ?
+        ORDER BY CREATED DESC LIMIT 1;
+        '''
+        cursor.execute(query, (report, str(fight), int(user_id)))
+        row = cursor.fetchone()
+        cursor.close()
+        return row
+
+    # Returns (user ID, name, URL, world, ETag, Last-Modified) for every validated user with a known profile
+    @timed("db_profiles")
+    def get_validated_profiles(self):
+        cursor = self.conn.cursor()
+        query = '''
+        SELECT u.ID, u.NAME, p.URL, p.WORLD, p.ETAG, p.LAST_MODIFIED
+        FROM users u JOIN lodestone_profiles p ON p.USER_ID = u.ID
+        WHERE u.VALIDATED = 1
+        ORDER BY p.CHECKED;
+        '''
+        cursor.execute(query)
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    # Returns when the profile checked longest ago was last checked, or None if no profile is known
+    @timed("db_profiles")
+    def get_oldest_profile_check(self):
+        cursor = self.conn.cursor()
+        query = 'SELECT MIN(p.CHECKED) FROM users u JOIN lodestone_profiles p ON p.USER_ID = u.ID WHERE u.VALIDATED = 1;'
+        cursor.execute(query)
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0]
+
+    @timed("db_profiles")
+    def has_lodestone_profile(self, user_id):
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT 1 FROM lodestone_profiles WHERE USER_ID = ?;', (int(user_id),))
+        row = cursor.fetchone()
+        cursor.close()
+        return row is not None
+
+    # Users validated before profiles were stored cannot be re-verified until they link their profile again
+    @timed("db_profiles")
+    def count_validated_without_profile(self):
+        cursor = self.conn.cursor()
+        query = 'SELECT COUNT(*) FROM users u LEFT JOIN lodestone_profiles p ON p.USER_ID = u.ID WHERE u.VALIDATED = 1 AND p.USER_ID IS NULL;'
+        cursor.execute(query)
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0]
+
+    # Marks profiles which could not be read as checked, so they wait for the next sweep like the others
+    @timed("db_profiles")
+    def touch_profiles(self, user_ids, checked):
+        cursor = self.conn.cursor()
+        query = 'UPDATE lodestone_profiles SET CHECKED = ? WHERE USER_ID = ?;'
+        cursor.executemany(query, [(checked, int(user_id)) for user_id in user_ids])
+        self.conn.commit()
+        cursor.close()
+
+    # Writes back many (user ID, name, world, ETag, Last-Modified, checked) results in one transaction
+    @timed("db_profiles")
+    def update_profiles(self, profiles):
+        cursor = self.conn.cursor()
+        query = 'UPDATE lodestone_profiles SET WORLD = ?, ETAG = ?, LAST_MODIFIED = ?, CHECKED = ? WHERE USER_ID = ?;'
+        cursor.executemany(query, [(world, etag, last_modified, checked, int(user_id)) for user_id, name, world, etag, last_modified, checked in profiles])
+        query = 'UPDATE users SET NAME = ? WHERE ID = ?;'
+        cursor.executemany(query, [(str(name), int(user_id)) for user_id, name, world, etag, last_modified, checked in profiles])
+        self.conn.commit()
+        cursor.close()
+        for user_id, name, world, etag, last_modified, checked in profiles:
+            self.update_cached_user(user_id, NAME, str(name))
+
+    # Already recorded posts are kept, since two reactions can import the same older post at once
+    @timed("db_reviews")
+    def add_review(self, message_id, channel_id, user_id, fflogs_url, role, name):
+        cursor = self.conn.cursor()
+        query = '''
+        INSERT OR IGNORE INTO reviews(MESSAGE_ID, CHANNEL_ID, USER_ID, FFLOGS_URL, ROLE, NAME, CREATED)
+        VALUES(?, ?, ?, ?, ?, ?, ?);
+        '''
+        cursor.execute(query, (int(message_id), int(channel_id), int(user_id), fflogs_url, role, str(name), time.time()))
+        self.conn.commit()
+        cursor.close()
+
+    # Returns (message ID, channel ID, user ID, fflogs URL, role, name, status) of a review post, or None
+    @timed("db_reviews")
+    def get_review(self, message_id):
+        cursor = self.conn.cursor()
+        query = 'SELECT MESSAGE_ID, CHANNEL_ID, USER_ID, FFLOGS_URL, ROLE, NAME, STATUS FROM reviews WHERE MESSAGE_ID = ?;'
+        cursor.execute(query, (int(message_id),))
+        row = cursor.fetchone()
+        cursor.close()
+        return row
+
+    # Resolves a pending review, returns False if another reviewer got to it first
+    @timed("db_reviews")
+    def resolve_review(self, message_id, reviewer_id, status):
+        cursor = self.conn.cursor()
+        query = "UPDATE reviews SET STATUS = ?, REVIEWER_ID = ?, RESOLVED = ? WHERE MESSAGE_ID = ? AND STATUS = 'pending';"
+        cursor.execute(query, (status, int(reviewer_id), time.time(), int(message_id)))
+        resolved = cursor.rowcount == 1
+        self.conn.commit()
+        cursor.close()
+        return resolved
+
+    @timed("db_reviews")
+    def count_pending_reviews(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM reviews WHERE STATUS = 'pending';")
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0]
 
     def close(self):
         self.conn.close()
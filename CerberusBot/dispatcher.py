@@ -0,0 +1,222 @@
+import asyncio
+import time
+import traceback
+from collections import deque
+from metrics import timer
+
+# Priorities, lower is sent first
+USER_REPLY = 0
+REVIEW = 1
+AUDIT = 2
+
+# Discord rejects messages longer than this
+MESSAGE_LIMIT = 2000
+
+def split_message(content, limit=MESSAGE_LIMIT):
+    chunks = []
+    current = ""
+    for line in content.split("\n"):
+        while len(line) > limit:
+            if len(current) > 0:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if len(current) == 0:
+            current = line
+        elif len(current) + 1 + len(line) <= limit:
+            current += "\n" + line
+        else:
+            chunks.append(current)
+            current = line
+    if len(current) > 0 or len(chunks) == 0:
+        chunks.append(current)
+    return chunks
+
+def destination_key(destination):
+    channel = getattr(destination, "channel", destination)
+    return getattr(channel, "id", id(channel))
+
+"""
+Central queue for everything the bot sends to Discord.
+
+User replies go out before manual review posts, which go out before audit
+output. Audit lines are buffered and sent as one batched message per flush
+interval, and every destination is held to a sliding window rate limit, so
+logging traffic never delays command responses. Each destination has at most
+one message in flight, so its messages arrive in the order they were queued.
+
+"""
+class OutboundDispatcher():
+    def __init__(self, bot, config, resolver=None):
+        self.bot = bot
+        self.config = config
+        self.resolver = resolver
+        self.workers = config.get("outbound_workers", 4)
+        self.audit_interval = config.get("audit_flush_interval", 5)
+        self.rate = config.get("channel_rate_limit", 5)
+        self.rate_period = config.get("channel_rate_period", 5)
+        self.queue = None
+        self.tasks = []
+        self.sequence = 0
+        self.audit_lines = {}
+        self.send_times = {}
+        # Destinations with a message in flight, and the items held back until it has gone out
+        self.busy = {}
+
+    # Workers are started on first use since they need the running event loop
+    def start(self):
+        if self.queue is not None:
+            return
+        self.queue = asyncio.PriorityQueue()
+        for i in range(self.workers):
+            self.tasks.append(asyncio.ensure_future(self.work()))
+        self.tasks.append(asyncio.ensure_future(self.flush_periodically()))
+
+    def enqueue(self, priority, destination, func):
+        self.start()
+        future = asyncio.get_event_loop().create_future()
+        # Mark failures of fire-and-forget sends as retrieved, they are printed by the worker
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self.sequence += 1
+        self.queue.put_nowait((priority, self.sequence, destination_key(destination), func, future))
+        return future
+
+    # Queues a message and returns a future of the last sent message, done once every chunk has gone out
+    def send(self, destination, content=None, embed=None, priority=USER_REPLY):
+        if content is None:
+            return self.enqueue(priority, destination, lambda: destination.send(embed=embed))
+
+        futures = []
+        for i, chunk in enumerate(split_message(content)):
+            chunk_embed = embed if i == 0 else None
+            futures.append(self.enqueue(priority, destination, lambda chunk=chunk, chunk_embed=chunk_embed: destination.send(chunk, embed=chunk_embed)))
+        if len(futures) == 1:
+            return futures[0]
+        return self.last_result(futures)
+
+    def last_result(self, futures):
+        future = asyncio.get_event_loop().create_future()
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+        def on_done(gathered):
+            if future.done():
+                return
+            if gathered.cancelled():
+                future.cancel()
+            elif gathered.exception() is not None:
+                future.set_exception(gathered.exception())
+            else:
+                future.set_result(gathered.result()[-1])
+        asyncio.gather(*futures).add_done_callback(on_done)
+        return future
+
+    # Sends a reply to a user and waits until all of it has gone out
+    async def reply(self, destination, content=None, embed=None):
+        return await self.send(destination, content, embed, USER_REPLY)
+
+    # Reactions are added in the given order, since a destination only has one message in flight at a time
+    def add_reactions(self, message, emojis):
+        for emoji in emojis:
+            self.enqueue(REVIEW, message, lambda emoji=emoji: message.add_reaction(emoji))
+
+    # Buffers a line for a logging channel without waiting for it to be sent
+    def audit(self, line, channel_id=None):
+        self.start()
+        if channel_id is None:
+            channel_id = self.config["logging_channel_id"]
+        self.audit_lines.setdefault(channel_id, []).append(line)
+
+    async def flush_audit(self):
+        batches = self.audit_lines
+        self.audit_lines = {}
+        for channel_id, lines in batches.items():
+            channel = self.bot.get_channel(channel_id)
+            if channel is None and self.resolver is not None:
+                try:
+                    channel = await self.resolver.get_channel(channel_id)
+                except Exception:
+                    traceback.print_exc()
+            if channel is not None:
+                self.send(channel, "\n".join(lines), priority=AUDIT)
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.audit_interval)
+            await self.flush_audit()
+
+    # Returns how long to wait before the destination may receive another message
+    def rate_limit_delay(self, key):
+        now = time.monotonic()
+        times = self.send_times.get(key)
+        if times is None:
+            times = self.send_times[key] = deque()
+        while len(times) > 0 and now - times[0] >= self.rate_period:
+            times.popleft()
+        if len(times) < self.rate:
+            times.append(now)
+            return 0
+        return times[0] + self.rate_period - now
+
+    # Holds an item back until the destination is free again
+    def hold(self, key, item):
+        self.busy.setdefault(key, []).append(item)
+
+    # Frees a destination and puts its held back items into the queue, where they keep their original order
+    def release(self, key, item=None):
+        held = self.busy.pop(key, [])
+        if item is not None:
+            held.append(item)
+        if self.queue is not None:
+            for held_item in held:
+                self.queue.put_nowait(held_item)
+
+    async def work(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await self.queue.get()
+            priority, sequence, key, func, future = item
+
+            # Only one message per destination is in flight, so messages arrive in the order they were queued
+            if key in self.busy:
+                self.hold(key, item)
+                self.queue.task_done()
+                continue
+            self.busy[key] = []
+
+            # Put messages for a rate limited destination back so other destinations are not held up
+            delay = self.rate_limit_delay(key)
+            if delay > 0:
+                loop.call_later(delay, self.release, key, item)
+                self.queue.task_done()
+                continue
+
+            try:
+                with timer("discord_send"):
+                    result = await func()
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                traceback.print_exc()
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.release(key)
+            self.queue.task_done()
+
+            if len(self.send_times) > 1000:
+                self.send_times = {key: times for key, times in self.send_times.items() if len(times) > 0 and time.monotonic() - times[-1] < self.rate_period}
+
+    async def stop(self):
+        if self.queue is None:
+            return
+        # Give the last audit lines a chance to go out before shutting down
+        await self.flush_audit()
+        try:
+            await asyncio.wait_for(self.queue.join(), self.rate_period)
+        except asyncio.TimeoutError:
+            pass
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.queue = None
@@ -0,0 +1,218 @@
+import asyncio
+import re
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fflogs_api import FFLogsAPIClient
+from metrics import INVALID_URL, NO_ELIGIBLE_FIGHTS, PARSE_FAILURE, Failure, count, timer
+from parse_pool import ParsePool
+from singleflight import SingleFlight
+
+# Whether the boss name from the API or the overview link text of a fight names one of the bosses, unknown fights are kept
+def mentions_boss(label, bosses):
+    if label is None:
+        return True
+    for boss in bosses:
+        # The overview page may leave out the difficulty, and "The Queen" must not match "The Queen's Guard"
+        for name in [boss, re.sub(" Savage$", "", boss)]:
+            if re.search(re.escape(name) + "(?![\\w'])", label) is not None:
+                return True
+    return False
+
+"""
+Async front-end for HTML_Parser so that scraping never blocks the discord.py event loop.
+
+Lodestone pages are downloaded over a pooled keep-alive HTTP session and
+parsed incrementally as they arrive. Selenium rendering runs in a bounded
+thread pool and the rendered FFLogs pages are parsed in a process pool.
+
+"""
+class AsyncFetcher():
+    def __init__(self, config, web, log_cache):
+        self.config = config
+        self.web = web
+        self.log_cache = log_cache
+        self.http_timeout = config.get("http_timeout", 15)
+        self.http_connections = config.get("http_connections", 10)
+        self.chunk_size = config.get("lodestone_chunk_size", 16 * 1024)
+        self.lodestone_base_url = config.get("lodestone_base_url")
+        self.report_max_fights = config.get("report_max_fights", 10)
+        workers = config.get("scraper_workers", config.get("browser_pool_size", 2))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scraper")
+        self.session = None
+        self.flights = SingleFlight()
+        self.parse_pool = ParsePool(config)
+
+        # FFLogs fights are either rendered with Selenium or read from the FFLogs API
+        self.api = None
+        if config.get("fflogs_backend", "selenium") == "api":
+            self.api = FFLogsAPIClient(config, self.get_session)
+
+    # The HTTP session has to be created from within the running event loop
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.http_connections)
+            timeout = aiohttp.ClientTimeout(total=self.http_timeout)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.session
+
+    async def run_blocking(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    # Spawns the parse workers ahead of the first log check
+    def start(self):
+        if self.api is None and self.parse_pool.enabled:
+            self.parse_pool.start()
+
+    # Parses a rendered summary page in the process pool, or in a scraper thread when parse_workers is 0
+    async def parse_fight_summary(self, page_source, report_code, fight):
+        if self.parse_pool.enabled:
+            try:
+                with timer("html_parse"):
+                    summary = await self.parse_pool.parse(page_source)
+            except BrokenProcessPool:
+                return None
+        else:
+            summary = await self.run_blocking(self.web.parse_fight_summary, page_source)
+        summary["report"] = report_code
+        summary["fight"] = fight
+        return summary
+
+    async def get_lodestone_data(self, lodestone_url):
+        # Validate Lodestone URL
+        if not self.web.is_valid_lodestone_url(lodestone_url):
+            return (self.config["error_codes"]["failure"], self.config["error_messages"]["invalid_lodestone_url"])
+
+        # Get Data from Lodestone, parsing while downloading and stopping once the profile has been read
+        try:
+            with timer("lodestone_fetch"):
+                async with self.get_session().get(self.get_lodestone_request_url(lodestone_url)) as response:
+                    parser = await self.stream_lodestone_page(response)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return (self.config["error_codes"]["failure"], self.config["error_messages"].get("lodestone_unreachable", "The Lodestone could not be reached. Please try again later."))
+        if parser.source is not None:
+            self.web.record_lodestone_page(lodestone_url, "".join(parser.source))
+
+        return self.web.lodestone_stream_result(parser)
+
+    # Lodestone requests can be sent to a local stub server instead of the live site
+    def get_lodestone_request_url(self, lodestone_url):
+        if self.lodestone_base_url is None:
+            return lodestone_url
+        return self.lodestone_base_url.rstrip("/") + "/lodestone/" + lodestone_url.split("/lodestone/", 1)[1]
+
+    # Feeds a Lodestone response to a stream parser until it has found its fields or the page ends
+    async def stream_lodestone_page(self, response, fields=None):
+        if fields is None:
+            parser = self.web.lodestone_stream_parser(encoding=response.charset)
+        else:
+            parser = self.web.lodestone_stream_parser(fields, response.charset)
+        with timer("lodestone_stream_parse"):
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                if parser.feed_bytes(chunk):
+                    count("lodestone_stream", "early_exit")
+                    break
+        return parser
+
+    # Returns (status code, (fight, player data)), with "fight=last" resolved to the actual fight number
+    async def get_log_data(self, fflogs_url, name):
+        # Validate FFLogs URL
+        fight_key = self.web.parse_fflogs_url(fflogs_url)
+        if fight_key is None:
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["invalid_logs_url"], INVALID_URL))
+
+        # Render the report only if nobody from the same pull has been checked recently,
+        # and let concurrent submissions of the same fight share a single render
+        summary = self.log_cache.get(*fight_key)
+        if summary is None:
+            status_code, summary = await self.flights.do(fight_key, self.fetch_fight_summary, fflogs_url, fight_key)
+            if status_code != self.config["error_codes"]["success"]:
+                return (status_code, summary)
+
+        status_code, data = self.web.select_player_data(summary, name)
+        if status_code != self.config["error_codes"]["success"]:
+            return (status_code, data)
+        return (status_code, (str(summary["fight"]), data))
+
+    async def fetch_fight_summary(self, fflogs_url, fight_key):
+        if self.api is not None:
+            with timer("fflogs_api"):
+                status_code, summary = await self.api.get_fight_summary(fight_key[0], fight_key[1])
+        else:
+            with timer("fflogs_render"):
+                status_code, data = await self.run_blocking(self.web.render_fight_summary, fflogs_url)
+            if status_code != self.config["error_codes"]["success"]:
+                return (status_code, data)
+            summary = await self.parse_fight_summary(data[0], fight_key[0], data[1])
+            if summary is None:
+                return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["broken_log_parsing"], PARSE_FAILURE))
+        if status_code == self.config["error_codes"]["success"] and self.web.is_complete_summary(summary):
+            self.log_cache.put(fight_key[0], fight_key[1], summary)
+        return (status_code, summary)
+
+    # Returns (status code, [(fight, player data)]) for the fights of a report against one of the given bosses
+    async def get_report_log_data(self, report_code, name, bosses):
+        status_code, fights = await self.flights.do((report_code, "fights"), self.fetch_report_fights, report_code)
+        if status_code != self.config["error_codes"]["success"]:
+            return (status_code, fights)
+
+        # Other encounters are dropped before keeping the last fights, so trash pulls cannot push the bosses out
+        fights = [fight for fight, boss_name in fights if mentions_boss(boss_name, bosses)][-self.report_max_fights:]
+
+        # Only fights nobody has checked recently have to be loaded
+        summaries = []
+        missing = []
+        for fight in fights:
+            summary = self.log_cache.get(report_code, fight)
+            if summary is None:
+                missing.append(fight)
+            else:
+                summaries.append(summary)
+        if len(missing) > 0:
+            status_code, loaded = await self.flights.do((report_code, tuple(missing)), self.fetch_fight_summaries, report_code, missing)
+            if status_code != self.config["error_codes"]["success"]:
+                return (status_code, loaded)
+            summaries += loaded
+
+        logs = []
+        for summary in sorted(summaries, key=lambda summary: int(summary["fight"])):
+            if summary["boss"] not in bosses:
+                continue
+            status_code, data = self.web.select_player_data(summary, name)
+            if status_code == self.config["error_codes"]["success"]:
+                logs.append((summary["fight"], data))
+        if len(logs) == 0:
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"].get("report_no_eligible_fights", "None of the fights in this report can be checked for your character: ") + str(name), NO_ELIGIBLE_FIGHTS))
+        return (self.config["error_codes"]["success"], logs)
+
+    # Returns (status code, [(fight, boss name or overview link text or None)]) for every fight of a report
+    async def fetch_report_fights(self, report_code):
+        if self.api is not None:
+            with timer("fflogs_api"):
+                return await self.api.get_report_fights(report_code)
+        with timer("fflogs_render"):
+            return await self.run_blocking(self.web.render_report_fights, report_code)
+
+    async def fetch_fight_summaries(self, report_code, fights):
+        if self.api is not None:
+            with timer("fflogs_api"):
+                status_code, summaries = await self.api.get_fight_summaries(report_code, fights)
+        else:
+            with timer("fflogs_render"):
+                status_code, pages = await self.run_blocking(self.web.render_fight_summaries, report_code, fights)
+            if status_code != self.config["error_codes"]["success"]:
+                return (status_code, pages)
+            summaries = await asyncio.gather(*[self.parse_fight_summary(page_source, report_code, fight) for page_source, fight in pages])
+            summaries = [summary for summary in summaries if summary is not None]
+        if status_code == self.config["error_codes"]["success"]:
+            for summary in summaries:
+                if self.web.is_complete_summary(summary):
+                    self.log_cache.put(report_code, summary["fight"], summary)
+        return (status_code, summaries)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+        self.executor.shutdown(wait=False)
+        self.parse_pool.close()
@@ -0,0 +1,230 @@
+import asyncio
+import time
+import aiohttp
+from metrics import API_ERROR, PARSE_FAILURE, Failure
+
+"""
+Reads fight summaries from the FFLogs v2 GraphQL API instead of rendering the report page.
+
+Returns the same summary layout as HTML_Parser.parse_fight_summary, so the rest
+of the bot does not care which backend produced it. Requests go through the
+shared keep-alive session of AsyncFetcher and the OAuth token is reused until
+shortly before it expires.
+
+"""
+FIGHTS_QUERY = """
+query($code: String!) {
+  reportData {
+    report(code: $code) {
+      fights { id name kill difficulty startTime endTime }
+    }
+  }
+}
+"""
+
+SUMMARY_QUERY = """
+query($code: String!, $fights: [Int]!) {
+  reportData {
+    report(code: $code) {
+      fights(fightIDs: $fights) { id name kill difficulty startTime endTime }
+      playerDetails(fightIDs: $fights)
+      damage: table(fightIDs: $fights, dataType: DamageDone)
+      healing: table(fightIDs: $fights, dataType: Healing)
+      deaths: table(fightIDs: $fights, dataType: Deaths)
+    }
+  }
+}
+"""
+
+# Tables read for every fight, in the same order as SUMMARY_QUERY
+FIGHT_FIELDS = [
+    ("fights", "fights(fightIDs: $ids) { id name kill difficulty startTime endTime }"),
+    ("playerDetails", "playerDetails(fightIDs: $ids)"),
+    ("damage", "table(fightIDs: $ids, dataType: DamageDone)"),
+    ("healing", "table(fightIDs: $ids, dataType: Healing)"),
+    ("deaths", "table(fightIDs: $ids, dataType: Deaths)")
+]
+
+# FFLogs difficulty ID of savage content
+SAVAGE_DIFFICULTY = 101
+
+class FFLogsAPIError(Exception):
+    pass
+
+class FFLogsAPIClient():
+    def __init__(self, config, get_session):
+        self.config = config
+        self.get_session = get_session
+        self.client_id = config.get("fflogs_client_id")
+        self.client_secret = config.get("fflogs_client_secret")
+        self.api_url = config.get("fflogs_api_url", "https://www.fflogs.com/api/v2/client")
+        self.token_url = config.get("fflogs_token_url", "https://www.fflogs.com/oauth/token")
+        self.token = None
+        self.token_expires = 0
+        self.token_lock = None
+
+    async def get_token(self):
+        if self.token is not None and time.monotonic() < self.token_expires:
+            return self.token
+
+        if self.token_lock is None:
+            self.token_lock = asyncio.Lock()
+        async with self.token_lock:
+            # Another request may have refreshed the token while we waited
+            if self.token is not None and time.monotonic() < self.token_expires:
+                return self.token
+
+            auth = aiohttp.BasicAuth(self.client_id, self.client_secret)
+            async with self.get_session().post(self.token_url, data={"grant_type": "client_credentials"}, auth=auth) as response:
+                if response.status != 200:
+                    raise FFLogsAPIError("Token request failed with status " + str(response.status))
+                data = await response.json()
+            self.token = data["access_token"]
+            self.token_expires = time.monotonic() + data.get("expires_in", 3600) - 60
+            return self.token
+
+    async def query(self, query, variables):
+        payload = {"query": query, "variables": variables}
+        for attempt in range(2):
+            token = await self.get_token()
+            headers = {"Authorization": "Bearer " + token}
+            async with self.get_session().post(self.api_url, json=payload, headers=headers) as response:
+                # The token was revoked before it expired, retry once with a fresh one
+                if response.status == 401 and attempt == 0:
+                    if self.token == token:
+                        self.token = None
+                    continue
+                if response.status != 200:
+                    raise FFLogsAPIError("API request failed with status " + str(response.status))
+                data = await response.json()
+                break
+        if data.get("errors"):
+            raise FFLogsAPIError(data["errors"][0].get("message", "Unknown API error"))
+        report = data["data"]["reportData"]["report"]
+        if report is None:
+            raise FFLogsAPIError("Report not found")
+        return report
+
+    # Returns (status code, summary) for a report code and fight number or "last"
+    async def get_fight_summary(self, report_code, fight):
+        try:
+            if fight == "last":
+                report = await self.query(FIGHTS_QUERY, {"code": report_code})
+                if len(report["fights"]) == 0:
+                    return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["broken_log_parsing"], PARSE_FAILURE))
+                fight = str(report["fights"][-1]["id"])
+
+            report = await self.query(SUMMARY_QUERY, {"code": report_code, "fights": [int(fight)]})
+        except (FFLogsAPIError, aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError):
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"].get("fflogs_api_error", "The logs could not be loaded from FFLogs. Please check that the report is public and try again."), API_ERROR))
+
+        if len(report["fights"]) == 0:
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["broken_log_parsing"], PARSE_FAILURE))
+
+        summary = summarize_report(report)
+        summary["report"] = report_code
+        summary["fight"] = fight
+        return (self.config["error_codes"]["success"], summary)
+
+    # Returns (status code, [(fight, boss name)]) for every fight of a report
+    async def get_report_fights(self, report_code):
+        try:
+            report = await self.query(FIGHTS_QUERY, {"code": report_code})
+        except (FFLogsAPIError, aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError):
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"].get("fflogs_api_error", "The logs could not be loaded from FFLogs. Please check that the report is public and try again."), API_ERROR))
+        return (self.config["error_codes"]["success"], [(str(fight["id"]), get_boss_name(fight)) for fight in report["fights"]])
+
+    # Returns (status code, [summary]) for several fights of a report, read in a single request
+    async def get_fight_summaries(self, report_code, fights):
+        try:
+            report = await self.query(build_summaries_query(fights), {"code": report_code})
+            summaries = []
+            for fight in fights:
+                fight_report = split_report(report, fight)
+                if len(fight_report["fights"]) == 0:
+                    continue
+                summary = summarize_report(fight_report)
+                summary["report"] = report_code
+                summary["fight"] = fight
+                summaries.append(summary)
+        except (FFLogsAPIError, aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError):
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"].get("fflogs_api_error", "The logs could not be loaded from FFLogs. Please check that the report is public and try again."), API_ERROR))
+        return (self.config["error_codes"]["success"], summaries)
+
+# Reads the tables of several fights in one request, every fight under its own aliases like "f3_damage"
+def build_summaries_query(fights):
+    fields = []
+    for fight in fights:
+        ids = "[" + str(int(fight)) + "]"
+        for key, field in FIGHT_FIELDS:
+            fields.append("f" + str(int(fight)) + "_" + key + ": " + field.replace("$ids", ids))
+    return "query($code: String!) {\n  reportData {\n    report(code: $code) {\n      " + "\n      ".join(fields) + "\n    }\n  }\n}\n"
+
+# Picks the tables of one fight out of an aliased report
+def split_report(report, fight):
+    return {key: report["f" + str(int(fight)) + "_" + key] for key, field in FIGHT_FIELDS}
+
+# The report page names savage encounters "[Boss] Savage", the API returns the bare encounter name
+def get_boss_name(fight):
+    boss_name = fight["name"]
+    if fight.get("difficulty") == SAVAGE_DIFFICULTY and not boss_name.endswith("Savage"):
+        boss_name += " Savage"
+    return boss_name
+
+def summarize_report(report):
+    fight = report["fights"][0]
+    boss_name = get_boss_name(fight)
+
+    fight_time = (fight["endTime"] - fight["startTime"]) // 1000
+    kill_info = ["Kill" if fight.get("kill") else "Wipe", fight_time]
+
+    return {
+        "boss": boss_name,
+        "kill_info": kill_info,
+        "players": get_players(report),
+        "damage": get_percent_table(report["damage"]),
+        "healing": get_percent_table(report["healing"]),
+        "deaths": get_death_table(report["deaths"], fight["startTime"])
+    }
+
+def get_table_entries(table):
+    try:
+        return table["data"]["entries"]
+    except (KeyError, TypeError):
+        return None
+
+def get_players(report):
+    try:
+        details = report["playerDetails"]["data"]["playerDetails"]
+        return [player["name"] for role in ["tanks", "healers", "dps"] for player in details.get(role, [])]
+    except (KeyError, TypeError):
+        entries = get_table_entries(report["damage"])
+        if entries is None:
+            return None
+        return [entry["name"] for entry in entries]
+
+def get_percent_table(table):
+    entries = get_table_entries(table)
+    if entries is None:
+        return None
+
+    total = sum(entry.get("total", 0) for entry in entries)
+    percents = []
+    for entry in entries:
+        if total > 0:
+            percents.append([entry["name"], round(100.0 * entry.get("total", 0) / total, 2)])
+        else:
+            percents.append([entry["name"], 0.0])
+    return percents
+
+def get_death_table(table, fight_start):
+    entries = get_table_entries(table)
+    if entries is None:
+        return None
+
+    deaths = []
+    for entry in entries:
+        death_time = (entry["timestamp"] - fight_start) // 1000
+        killing_blow = entry.get("killingBlow") or {}
+        deaths.append([entry["name"], death_time, killing_blow.get("name", "")])
+    return deaths
@@ -0,0 +1,145 @@
+import lxml.html
+
+"""
+Fast extraction of FFLogs fight summaries with lxml.
+
+The rendered summary page is parsed once by libxml2 and a single XPath query
+collects every section the bot needs. The result has the same layout as
+HTML_Parser.summarize_fight, for all players in the fight.
+
+"""
+DAMAGE_TABLE_ID = "summary-damage-done-0"
+HEALING_TABLE_ID = "summary-healing-done-0"
+DEATHS_TABLE_ID = "summary-deaths-0"
+BOSS_ID = "filter-fight-boss-text"
+FIGHT_DETAILS_ID = "filter-fight-details-text"
+
+SECTIONS_XPATH = (
+    "//*[@id='" + BOSS_ID + "' or @id='" + FIGHT_DETAILS_ID + "' or @id='" + DAMAGE_TABLE_ID + "'"
+    " or @id='" + HEALING_TABLE_ID + "' or @id='" + DEATHS_TABLE_ID + "']"
+    " | //table[contains(concat(' ', normalize-space(@class), ' '), ' composition-table ')]"
+)
+
+parser = lxml.html.HTMLParser(remove_comments=True, remove_pis=True)
+
+def extract_fight_summary(page_source):
+    root = lxml.html.fromstring(page_source, parser=parser)
+
+    # Pick out every needed section in one traversal, keeping the first match like BeautifulSoup's find
+    sections = {}
+    for elem in root.xpath(SECTIONS_XPATH):
+        key = elem.get("id")
+        if key not in [BOSS_ID, FIGHT_DETAILS_ID, DAMAGE_TABLE_ID, HEALING_TABLE_ID, DEATHS_TABLE_ID]:
+            key = "composition-table"
+        if key not in sections:
+            sections[key] = elem
+
+    return {
+        "boss": get_boss_name(sections.get(BOSS_ID)),
+        "kill_info": get_kill_info(sections.get(FIGHT_DETAILS_ID)),
+        "players": get_players(sections.get("composition-table")),
+        "damage": get_percent_table(sections.get(DAMAGE_TABLE_ID)),
+        "healing": get_percent_table(sections.get(HEALING_TABLE_ID)),
+        "deaths": get_death_table(sections.get(DEATHS_TABLE_ID))
+    }
+
+def has_class(elem, class_name):
+    return class_name in elem.get("class", "").split()
+
+def find_by_class(elem, tag, class_name):
+    for child in elem.iter(tag):
+        if child is not elem and has_class(child, class_name):
+            return child
+    return None
+
+def get_boss_name(elem):
+    if elem is None or elem.text is None:
+        return None
+    return elem.text
+
+def get_kill_info(elem):
+    if elem is None:
+        return None
+
+    # Is Fight a Wipe?
+    wipe_elem = find_by_class(elem, "span", "wipe")
+    if wipe_elem is not None:
+        fight_time = get_fight_time(wipe_elem)
+        if fight_time is None:
+            return None
+        return ["Wipe", fight_time]
+
+    # Is Fight a Kill?
+    kill_elem = find_by_class(elem, "span", "kill")
+    if kill_elem is not None:
+        fight_time = get_fight_time(kill_elem)
+        if fight_time is None:
+            return None
+        return ["Kill", fight_time]
+
+    # No Data Found
+    return None
+
+def get_fight_time(elem):
+    duration_elem = find_by_class(elem, "span", "fight-duration")
+    if duration_elem is None:
+        return None
+    return parse_minutes_seconds(duration_elem.text_content().replace("(", "").replace(")", ""))
+
+# Converts a Min:Sec string to seconds
+def parse_minutes_seconds(text):
+    try:
+        time_data = text.replace("\n", "").replace(" ", "").split(":")
+        return (int(time_data[0]) * 60) + int(time_data[1])
+    except (ValueError, IndexError):
+        return None
+
+def get_players(table):
+    if table is None:
+        return None
+    return [entry.text_content() for entry in table.iter("a")]
+
+def get_percent_table(table):
+    if table is None:
+        return None
+
+    entries = []
+    for table_entry in table.iter("a"):
+        percent_done = None
+        percent_entry = table_entry.getparent().getnext()
+        if percent_entry is not None:
+            percent_elem = find_by_class(percent_entry, "div", "report-amount-percent")
+            if percent_elem is not None and percent_elem.text is not None:
+                try:
+                    percent_done = float(percent_elem.text.replace("%", ""))
+                except ValueError:
+                    percent_done = None
+        entries.append([table_entry.text_content(), percent_done])
+    return entries
+
+def get_death_table(table):
+    if table is None:
+        return None
+
+    deaths = []
+    for death_entry in table.iter("a"):
+        death_time, death_mechanic = None, None
+
+        # Get Death Mechanic
+        death_mechanic_parent = death_entry.getparent().getnext()
+        if death_mechanic_parent is not None:
+            death_mechanic = ""
+            for span in death_mechanic_parent.iter("span"):
+                if span.get("id", "").startswith("death-ability"):
+                    death_mechanic = span.text
+                    break
+
+            # Get Death Time
+            death_time_parent = death_mechanic_parent.getnext()
+            if death_time_parent is not None and death_time_parent.text is not None:
+                death_time = parse_minutes_seconds(death_time_parent.text)
+
+        if death_time is None or death_mechanic is None:
+            death_time, death_mechanic = None, None
+        deaths.append([death_entry.text_content(), death_time, death_mechanic])
+    return deaths
@@ -0,0 +1,30 @@
+import os
+import re
+
+"""
+Saves and loads raw Lodestone and FFLogs pages so the parsers can be replayed offline.
+
+Pages are stored as <directory>/<kind>/<key>.html, where kind is "lodestone" or "fflogs".
+
+"""
+class FixtureStore():
+    def __init__(self, directory):
+        self.directory = directory
+
+    def record(self, kind, key, page_source):
+        kind_directory = os.path.join(self.directory, kind)
+        os.makedirs(kind_directory, exist_ok=True)
+        file_name = re.sub("[^a-zA-Z0-9_-]", "_", str(key)) + ".html"
+        with open(os.path.join(kind_directory, file_name), "w", encoding="utf-8") as file:
+            file.write(page_source)
+
+    # Yields (key, page source) for every recorded page of a kind
+    def load_all(self, kind):
+        kind_directory = os.path.join(self.directory, kind)
+        if not os.path.isdir(kind_directory):
+            return
+        for file_name in sorted(os.listdir(kind_directory)):
+            if not file_name.endswith(".html"):
+                continue
+            with open(os.path.join(kind_directory, file_name), encoding="utf-8") as file:
+                yield (file_name[:-len(".html")], file.read())
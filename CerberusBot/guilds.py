@@ -0,0 +1,50 @@
+from policy import Policy
+
+"""
+Settings of every Discord server the bot serves.
+
+Each entry of "guilds" in config.json maps a guild ID to the keys that differ
+for that server, such as roles, channels, thresholds and messages. Keys which
+are not overridden fall back to the top level of the config, so a config with
+only "server_id" keeps working as a single server setup.
+
+"""
+class GuildSettings():
+    def __init__(self, config):
+        self.config = config
+        self.settings = {}
+        self.policies = {}
+
+        guilds = config.get("guilds")
+        if not guilds:
+            guilds = {str(config["server_id"]): {}}
+        for guild_id, overrides in guilds.items():
+            settings = dict(config)
+            settings.pop("guilds", None)
+            settings.update(overrides)
+            settings["server_id"] = int(guild_id)
+            self.settings[int(guild_id)] = settings
+
+    # Returns the settings of a guild, or None if the bot is not configured for it
+    def get(self, guild_id):
+        return self.settings.get(guild_id)
+
+    def all(self):
+        return list(self.settings.values())
+
+    # Finds a guild by its configured "name" or its ID
+    def find(self, name):
+        for settings in self.settings.values():
+            if name.lower() == str(settings.get("name", "")).lower() or name == str(settings["server_id"]):
+                return settings
+        return None
+
+    # Each guild scores logs with its own thresholds and rules
+    def get_policy(self, guild_id):
+        policy = self.policies.get(guild_id)
+        if policy is None:
+            policy = self.policies[guild_id] = Policy(self.settings[guild_id])
+        return policy
+
+    def get_name(self, settings):
+        return str(settings.get("name", settings["server_id"]))
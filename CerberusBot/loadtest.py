@@ -0,0 +1,551 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import time
+import discord
+from aiohttp import web
+from bot import create_bot, role, verify
+from metrics import registry
+from util import load_config
+
+"""
+End-to-end load test of the command handlers against local stub servers.
+
+Simulated users run !verify, !verify [URL] and !role drs [URL] through the real
+handlers, queue, fetcher, policy and database, while a fake gateway stands in
+for Discord and aiohttp stub servers stand in for the Lodestone and the FFLogs
+API. Manual reviews are answered with reactions by a simulated staff member.
+    python loadtest.py --users 2000 --ramp 60 --output loadtest_results.json
+
+"""
+message_ids = itertools.count(1000000)
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize_samples(samples):
+    if len(samples) == 0:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "p50_ms": 1000 * percentile(samples, 0.50),
+        "p95_ms": 1000 * percentile(samples, 0.95),
+        "p99_ms": 1000 * percentile(samples, 0.99),
+        "max_ms": 1000 * max(samples)
+    }
+
+# Resident set size in MB, falling back to the peak where /proc is not available
+def current_memory_mb():
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# ----------------------------------------------------------------------
+# Fake Gateway
+# ----------------------------------------------------------------------
+class FakeRole():
+    def __init__(self, role_id):
+        self.id = role_id
+
+class FakeMessage():
+    def __init__(self, channel, content=None, embed=None, author=None):
+        self.id = next(message_ids)
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.author = author
+
+    async def add_reaction(self, emoji):
+        await self.channel.gateway.discord_call()
+
+    async def delete(self):
+        await self.channel.gateway.discord_call()
+
+class FakeTextChannel():
+    def __init__(self, gateway, channel_id, on_message=None):
+        self.gateway = gateway
+        self.id = channel_id
+        self.on_message = on_message
+        self.messages = 0
+
+    async def send(self, content=None, embed=None):
+        await self.gateway.discord_call()
+        self.messages += 1
+        message = FakeMessage(self, content, embed)
+        if self.on_message is not None:
+            self.on_message(message)
+        return message
+
+    def get_partial_message(self, message_id):
+        message = FakeMessage(self)
+        message.id = message_id
+        return message
+
+class FakeDMChannel(discord.DMChannel):
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+# A simulated user, whose DMs are collected in a queue
+class FakeUser():
+    def __init__(self, gateway, user_id, name):
+        self.gateway = gateway
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.discriminator = "0001"
+        self.avatar_url = ""
+        self.bot = False
+        self.dm_channel = FakeDMChannel(next(message_ids))
+        self.replies = asyncio.Queue()
+
+    async def send(self, content=None, embed=None):
+        await self.gateway.discord_call()
+        self.replies.put_nowait(content)
+        return FakeMessage(self.dm_channel, content, embed)
+
+class FakeMember():
+    def __init__(self, user, guild):
+        self.user = user
+        self.guild = guild
+        self.id = user.id
+        self.name = user.name
+        self.display_name = user.display_name
+        self.bot = user.bot
+        self.roles = []
+
+    async def add_roles(self, role):
+        await self.guild.gateway.discord_call()
+        self.roles.append(role)
+
+    async def edit(self, nick=None):
+        await self.guild.gateway.discord_call()
+        self.display_name = nick
+
+class FakeGuild():
+    def __init__(self, gateway, guild_id):
+        self.gateway = gateway
+        self.id = guild_id
+        self.members = {}
+        self.chunked = True
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    def get_role(self, role_id):
+        return FakeRole(role_id)
+
+class FakeContext():
+    def __init__(self, bot, user):
+        self.bot = bot
+        self.author = user
+        self.channel = user.dm_channel
+        self.message = FakeMessage(user.dm_channel, author=user)
+        self.command = None
+
+    async def send(self, content=None, embed=None):
+        return await self.author.send(content, embed=embed)
+
+# Replaces the Discord cache lookups of the bot with in-memory guilds, channels and users
+class FakeGateway():
+    def __init__(self, latency):
+        self.latency = latency
+        self.guilds = {}
+        self.channels = {}
+        self.users = {}
+
+    async def discord_call(self):
+        if self.latency > 0:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+
+    def attach(self, bot):
+        bot.get_guild = self.guilds.get
+        bot.get_channel = self.channels.get
+        bot.get_user = self.users.get
+
+    def add_guild(self, guild_id):
+        guild = self.guilds[guild_id] = FakeGuild(self, guild_id)
+        return guild
+
+    def add_channel(self, channel_id, on_message=None):
+        channel = self.channels[channel_id] = FakeTextChannel(self, channel_id, on_message)
+        return channel
+
+    def add_user(self, user_id, name, guild=None):
+        user = self.users[user_id] = FakeUser(self, user_id, name)
+        if guild is not None:
+            guild.members[user_id] = FakeMember(user, guild)
+        return user
+
+class FakeReactionPayload():
+    def __init__(self, guild_id, channel_id, message_id, emoji, member):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.emoji = emoji
+        self.member = member
+        self.user_id = member.id
+
+# ----------------------------------------------------------------------
+# Stub Servers
+# ----------------------------------------------------------------------
+"""
+Local stand-ins for the Lodestone character pages and the FFLogs v2 API.
+
+Every response is delayed by an exponentially distributed latency and a share
+of them fail with a 503, to see how the bot degrades when the sites are slow.
+
+"""
+class StubServers():
+    def __init__(self, args):
+        self.args = args
+        self.tokens = {}
+        self.reports = {}
+        self.runner = None
+        self.port = None
+
+    async def start(self):
+        app = web.Application(middlewares=[self.latency_middleware])
+        app.router.add_get("/lodestone/character/{character_id}/", self.handle_lodestone)
+        app.router.add_post("/oauth/token", self.handle_token)
+        app.router.add_post("/api/v2/client", self.handle_graphql)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        self.port = self.runner.addresses[0][1]
+
+    def get_url(self, path=""):
+        return "http://127.0.0.1:" + str(self.port) + path
+
+    @web.middleware
+    async def latency_middleware(self, request, handler):
+        if request.path.startswith("/lodestone"):
+            latency = self.args.lodestone_latency
+        else:
+            latency = self.args.fflogs_latency
+        if latency > 0:
+            await asyncio.sleep(random.expovariate(1 / latency))
+        if random.random() < self.args.error_rate:
+            return web.Response(status=503)
+        return await handler(request)
+
+    async def handle_lodestone(self, request):
+        character_id = request.match_info["character_id"]
+        name, token = self.tokens.get(character_id, ("Unknown Character", ""))
+        page = '<html><head><title>' + name + '</title></head><body>'
+        page += '<div class="frame__chara"><p class="frame__chara__name">' + name + '</p>'
+        page += '<p class="frame__chara__world"><i class="xiv-lds-home-world"></i>Cerberus\xa0(Chaos)</p></div>'
+        page += '<div class="character__selfintroduction">' + token + '<br/>Load test character</div>'
+        page += '<div class="character__content">' + '<p class="filler">Lodestone</p>' * (self.args.lodestone_page_kb * 30) + '</div>'
+        page += '</body></html>'
+        return web.Response(text=page, content_type="text/html")
+
+    async def handle_token(self, request):
+        return web.json_response({"access_token": "loadtest", "expires_in": 3600})
+
+    # Answers the fight list, single fight and aliased multi-fight queries of FFLogsAPIClient
+    async def handle_graphql(self, request):
+        payload = await request.json()
+        code = payload["variables"]["code"]
+        players = self.reports.get(code)
+        if players is None:
+            return web.json_response({"data": {"reportData": {"report": None}}})
+
+        query = payload["query"]
+        if "table(" not in query:
+            report = {"fights": [self.get_fight(code, fight) for fight in range(1, self.args.fights + 1)]}
+        elif "fights" in payload["variables"]:
+            report = self.get_fight_report(code, payload["variables"]["fights"][0], players)
+        else:
+            report = {}
+            for fight in sorted(set(int(fight) for fight in re.findall("f([0-9]+)_fights", query))):
+                for key, value in self.get_fight_report(code, fight, players).items():
+                    report["f" + str(fight) + "_" + key] = value
+        return web.json_response({"data": {"reportData": {"report": report}}})
+
+    def get_fight(self, code, fight):
+        rng = random.Random(code + "-" + str(fight))
+        return {"id": fight, "name": "Trinity Avowed", "kill": rng.random() < 0.7, "difficulty": 101, "startTime": 0, "endTime": 20 * 60 * 1000}
+
+    def get_fight_report(self, code, fight, players):
+        rng = random.Random(code + "-" + str(fight) + "-tables")
+        fight = self.get_fight(code, fight)
+        damage = [{"name": player, "total": rng.randint(800, 1200)} for player in players]
+        healing = [{"name": player, "total": rng.randint(0, 1000)} for player in players]
+        deaths = []
+        for player in players:
+            for i in range(rng.choice([0, 0, 0, 1, 1, 2, 3])):
+                mechanic = rng.choice(["Heat Shock", "Cold Shock", "Attack"])
+                deaths.append({"name": player, "timestamp": rng.randint(0, fight["endTime"]), "killingBlow": {"name": mechanic}})
+        return {
+            "fights": [fight],
+            "playerDetails": {"data": {"playerDetails": {"dps": [{"name": player} for player in players]}}},
+            "damage": {"data": {"entries": damage}},
+            "healing": {"data": {"entries": healing}},
+            "deaths": {"data": {"entries": deaths}}
+        }
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+# ----------------------------------------------------------------------
+# Load Test
+# ----------------------------------------------------------------------
+class LoadTest():
+    def __init__(self, config, args):
+        self.config = config
+        self.args = args
+        self.stubs = StubServers(args)
+        self.gateway = FakeGateway(args.discord_latency)
+        self.bot = None
+        self.latencies = {}
+        self.outcomes = {}
+        self.lags = []
+        self.timeline = []
+        self.reactions = []
+        self.running = True
+
+    def observe(self, name, seconds):
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def outcome(self, name):
+        self.outcomes[name] = self.outcomes.get(name, 0) + 1
+
+    def setup(self):
+        self.bot = create_bot(self.config)
+        self.gateway.attach(self.bot)
+        self.guilds = []
+        for settings in self.bot.guild_settings.all():
+            guild = self.gateway.add_guild(settings["server_id"])
+            self.gateway.add_channel(settings["logging_channel_id"])
+            self.gateway.add_channel(settings["manual_review_channel_id"], lambda message, settings=settings: self.schedule_review(settings, message))
+            reviewer = self.gateway.add_user(next(message_ids), "Load Test Staff", guild)
+            self.guilds.append((settings, guild, guild.members[reviewer.id]))
+
+        # Players of the same report share a fight, like a real raid group submitting after a run
+        self.users = []
+        for i in range(self.args.users):
+            settings, guild, reviewer = self.guilds[i % len(self.guilds)]
+            character_id = str(10000000 + i)
+            name = "Tester U%07d" % i
+            user = self.gateway.add_user(900000000000000000 + i, name, guild)
+            code = "load%05d" % (i // self.args.group_size)
+            self.stubs.reports.setdefault(code, []).append(name)
+            self.users.append((user, character_id, name, code))
+
+    def schedule_review(self, settings, message):
+        if message.embed is None:
+            return
+        self.reactions.append(asyncio.ensure_future(self.review(settings, message)))
+
+    async def review(self, settings, message):
+        await asyncio.sleep(random.expovariate(1 / self.args.review_delay))
+        reviewer = next(member for guild_settings, guild, member in self.guilds if guild_settings is settings)
+        emoji = settings["accept_emoji"] if random.random() < 0.5 else settings["reject_emoji"]
+        start = time.perf_counter()
+        await self.bot.on_raw_reaction_add(FakeReactionPayload(settings["server_id"], message.channel.id, message.id, emoji, reviewer))
+        self.observe("reaction", time.perf_counter() - start)
+
+    # Runs a command the way discord.py would, checks first
+    async def invoke(self, command, ctx, *args):
+        if not await command.can_run(ctx):
+            return False
+        await command.callback(ctx, *args)
+        return True
+
+    async def next_reply(self, user, timeout):
+        try:
+            return await asyncio.wait_for(user.replies.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def run_user(self, user, character_id, name, code):
+        ctx = FakeContext(self.bot, user)
+        error_messages = self.config["error_messages"]
+
+        # Generate a token and put it on the stub Lodestone profile
+        start = time.perf_counter()
+        await self.invoke(verify, ctx)
+        self.observe("verify_token", time.perf_counter() - start)
+        reply = await self.next_reply(user, self.args.timeout)
+        await self.next_reply(user, self.args.timeout)
+        if reply is None or not reply.startswith(error_messages["validation_token"]):
+            self.outcome("verify_token_failed")
+            return
+        self.stubs.tokens[character_id] = (name, reply[len(error_messages["validation_token"]):])
+
+        start = time.perf_counter()
+        await self.invoke(verify, ctx, "https://na.finalfantasyxiv.com/lodestone/character/" + character_id + "/")
+        self.observe("verify", time.perf_counter() - start)
+        reply = await self.next_reply(user, self.args.timeout)
+        if reply is None or not reply.startswith(error_messages["validation_success"]):
+            self.outcome("verify_failed")
+            return
+
+        # Submit the logs and wait for the verdict
+        start = time.perf_counter()
+        fflogs_url = "https://www.fflogs.com/reports/" + code
+        if random.random() >= self.args.report_share:
+            fflogs_url += "#fight=" + str(random.randint(1, self.args.fights))
+        if not await self.invoke(role, ctx, "drs", fflogs_url):
+            self.outcome("role_check_failed")
+            return
+        self.observe("role_ack", time.perf_counter() - start)
+        reply = await self.next_reply(user, self.args.timeout)
+        if reply is None or not reply.startswith("Checking provided logs."):
+            self.outcome("role_not_queued")
+            return
+        reply = await self.next_reply(user, self.args.timeout)
+        if reply is not None and reply.startswith("Checked "):
+            reply = await self.next_reply(user, self.args.timeout)
+        if reply is None:
+            self.outcome("role_timeout")
+            return
+        self.observe("role_result", time.perf_counter() - start)
+        self.outcome("role_completed")
+
+    # Waits for the queued log checks, the messages still to be sent and the manual reviews they lead to
+    async def drain(self):
+        while True:
+            reactions = len(self.reactions)
+            if self.bot.log_queue.queue is not None:
+                await self.bot.log_queue.queue.join()
+            if self.bot.outbound.queue is not None:
+                await self.bot.outbound.queue.join()
+            await asyncio.gather(*self.reactions)
+            # Rate limited messages wait outside of the queue for a while
+            await asyncio.sleep(self.config.get("channel_rate_period", 5))
+            if len(self.reactions) == reactions and (self.bot.outbound.queue is None or self.bot.outbound.queue.empty()):
+                return
+
+    async def monitor_loop(self):
+        interval = 0.05
+        loop = asyncio.get_event_loop()
+        while self.running:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.lags.append(max(0.0, loop.time() - start - interval))
+
+    async def sample(self, started):
+        while self.running:
+            await asyncio.sleep(self.args.sample_interval)
+            recent = self.lags[-int(self.args.sample_interval / 0.05):]
+            outbound_queue = self.bot.outbound.queue
+            self.timeline.append({
+                "elapsed_s": round(time.perf_counter() - started, 2),
+                "rss_mb": round(current_memory_mb(), 1),
+                "max_loop_lag_ms": round(1000 * max(recent), 1) if len(recent) > 0 else 0.0,
+                "queued_log_checks": len(self.bot.log_queue.pending),
+                "outbound_queue": outbound_queue.qsize() if outbound_queue is not None else 0,
+                "completed": sum(self.outcomes.values())
+            })
+
+    async def run(self):
+        await self.stubs.start()
+        self.config["lodestone_base_url"] = self.stubs.get_url()
+        self.config["fflogs_api_url"] = self.stubs.get_url("/api/v2/client")
+        self.config["fflogs_token_url"] = self.stubs.get_url("/oauth/token")
+        self.setup()
+        registry.reset()
+
+        started = time.perf_counter()
+        monitors = [asyncio.ensure_future(self.monitor_loop()), asyncio.ensure_future(self.sample(started))]
+        tasks = []
+        for i, (user, character_id, name, code) in enumerate(self.users):
+            # Spread the users evenly over the ramp up
+            delay = started + self.args.ramp * i / len(self.users) - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(self.run_user(user, character_id, name, code)))
+        await asyncio.gather(*tasks)
+        await self.drain()
+        elapsed = time.perf_counter() - started
+
+        self.running = False
+        await asyncio.gather(*monitors)
+        await self.bot.close()
+        await self.stubs.stop()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        db_stages = {}
+        for stage, histogram in registry.histograms.items():
+            if stage.startswith("db_"):
+                db_stages[stage] = {
+                    "calls": histogram.count,
+                    "total_s": round(histogram.sum, 3),
+                    "mean_ms": 1000 * histogram.sum / histogram.count if histogram.count > 0 else 0.0,
+                    "p95_ms_bucket": 1000 * histogram.percentile(0.95),
+                    "share_of_run": histogram.sum / elapsed if elapsed > 0 else 0.0
+                }
+        return {
+            "users": self.args.users,
+            "elapsed_s": elapsed,
+            "outcomes": self.outcomes,
+            "commands": {name: summarize_samples(samples) for name, samples in self.latencies.items()},
+            "event_loop_lag": summarize_samples(self.lags),
+            "db": db_stages,
+            "counters": {name + "/" + label: value for (name, label), value in registry.counters.items()},
+            "timeline": self.timeline
+        }
+
+# Points the bot at the stubs and a throwaway database, keeping the thresholds and messages of the real config
+def prepare_config(config, args, directory):
+    config["database"] = os.path.join(directory, "loadtest.db")
+    config["fflogs_backend"] = "api"
+    config["fflogs_client_id"] = "loadtest"
+    config["fflogs_client_secret"] = "loadtest"
+    config["metrics_port"] = None
+    config["reverify_enabled"] = False
+    config.pop("fixture_record_dir", None)
+    for override in args.set:
+        key, value = override.split("=", 1)
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    return config
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Load test the command handlers against local stub servers.")
+    arg_parser.add_argument("--config", default="config.json")
+    arg_parser.add_argument("--users", type=int, default=1000, help="number of simulated users")
+    arg_parser.add_argument("--ramp", type=float, default=30, help="seconds over which the users start")
+    arg_parser.add_argument("--group-size", type=int, default=8, help="users submitting the same report")
+    arg_parser.add_argument("--fights", type=int, default=3, help="fights per report the users pick from")
+    arg_parser.add_argument("--report-share", type=float, default=0.5, help="share of users submitting a whole report instead of one fight")
+    arg_parser.add_argument("--lodestone-latency", type=float, default=0.3, help="mean Lodestone response time in seconds")
+    arg_parser.add_argument("--lodestone-page-kb", type=int, default=150, help="approximate size of a Lodestone page")
+    arg_parser.add_argument("--fflogs-latency", type=float, default=1.0, help="mean FFLogs API response time in seconds")
+    arg_parser.add_argument("--discord-latency", type=float, default=0.05, help="mean Discord API call time in seconds")
+    arg_parser.add_argument("--error-rate", type=float, default=0.02, help="share of stub responses failing with a 503")
+    arg_parser.add_argument("--review-delay", type=float, default=5, help="mean seconds before a manual review is answered")
+    arg_parser.add_argument("--timeout", type=float, default=600, help="seconds a user waits for a reply")
+    arg_parser.add_argument("--sample-interval", type=float, default=1, help="seconds between timeline samples")
+    arg_parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="override a config key, e.g. --set log_queue_size=5000")
+    arg_parser.add_argument("--output", default="loadtest_results.json")
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        config = prepare_config(load_config(args.config), args, directory)
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(LoadTest(config, args).run())
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    json.dump({key: value for key, value in results.items() if key != "timeline"}, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
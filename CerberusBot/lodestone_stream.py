@@ -0,0 +1,85 @@
+import codecs
+from html.parser import HTMLParser
+
+"""
+Incremental parser for Lodestone character pages.
+
+Fed the page chunk by chunk, it captures the character name, world and the
+start of the self introduction, and reports done as soon as every requested
+field has been seen, so the rest of the page never has to be downloaded.
+With the default fields the result matches parse_lodestone_html.
+
+"""
+NAME = "name"
+WORLD = "world"
+BIO = "bio"
+
+# The fields read by parse_lodestone_html, in the same order
+CHARACTER_FIELDS = (NAME, BIO, WORLD)
+
+FIELD_CLASSES = {
+    NAME: ("p", "frame__chara__name"),
+    WORLD: ("p", "frame__chara__world"),
+    BIO: ("div", "character__selfintroduction")
+}
+
+class LodestoneStreamParser(HTMLParser):
+    def __init__(self, fields=CHARACTER_FIELDS, encoding="utf-8", keep_source=False):
+        super().__init__()
+        self.fields = fields
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        # The part of the page read so far, kept for fixture recording
+        self.source = [] if keep_source else None
+        self.values = {}
+        self.current = None
+        self.text = ""
+
+    @property
+    def done(self):
+        return len(self.values) == len(self.fields)
+
+    # Feeds a chunk of the raw response body and returns True once every field has been found
+    def feed_bytes(self, chunk):
+        text = self.decoder.decode(chunk)
+        if self.source is not None:
+            self.source.append(text)
+        self.feed(text)
+        return self.done
+
+    def handle_starttag(self, tag, attrs):
+        # The name and introduction are the first child node of their element, so any child tag ends them
+        if self.current in (NAME, BIO):
+            self.finish()
+        if self.current is not None:
+            return
+
+        classes = dict(attrs).get("class") or ""
+        for field in self.fields:
+            field_tag, field_class = FIELD_CLASSES[field]
+            if field not in self.values and tag == field_tag and field_class in classes.split():
+                self.current = field
+                self.text = ""
+                return
+
+    def handle_endtag(self, tag):
+        if self.current is not None and tag == FIELD_CLASSES[self.current][0]:
+            self.finish()
+
+    def handle_data(self, data):
+        if self.current is not None:
+            self.text += data
+
+    def finish(self):
+        self.values[self.current] = self.text
+        self.current = None
+        self.text = ""
+
+    # Returns the values in the order of the requested fields, or None if a field is missing
+    def result(self):
+        if not self.done:
+            return None
+        values = dict(self.values)
+        if WORLD in values:
+            # Lodestone World strings are always on the format "[World]\xa0([Data Center])"
+            values[WORLD] = values[WORLD].split('\xa0')[0]
+        return tuple(values[field] for field in self.fields)
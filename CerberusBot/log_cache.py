@@ -0,0 +1,62 @@
+import json
+import time
+from collections import OrderedDict
+
+"""
+Caches parsed FFLogs fight summaries by report code and fight number.
+
+Recently used fights are kept in an in-memory LRU in front of a SQLite table,
+so any player from the same pull can be checked without rendering the report again.
+
+"""
+class LogCache():
+    def __init__(self, config, db):
+        self.db = db
+        self.size = config.get("log_cache_size", 256)
+        self.ttl = config.get("log_cache_ttl", 7 * 24 * 60 * 60)
+        # "fight=last" points to a different fight as soon as another pull is uploaded
+        self.last_ttl = config.get("log_cache_last_ttl", 5 * 60)
+        self.entries = OrderedDict()
+        self.db.delete_expired_fights(time.time())
+
+    def get(self, report, fight):
+        now = time.time()
+        key = (report, fight)
+
+        # Memory Tier
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self.entries.move_to_end(key)
+                return entry[1]
+            del self.entries[key]
+
+        # SQLite Tier
+        row = self.db.get_cached_fight(report, fight, now)
+        if row is None:
+            return None
+        summary = json.loads(row[1])
+        self.remember(key, row[0], summary)
+        return summary
+
+    def put(self, report, fight, summary):
+        now = time.time()
+        if fight == "last":
+            self.store(report, fight, now + self.last_ttl, summary)
+        else:
+            self.store(report, fight, now + self.ttl, summary)
+
+        # A resolved "fight=last" can also answer requests for the actual fight number
+        if summary["fight"] != fight:
+            self.store(report, summary["fight"], now + self.ttl, summary)
+
+    def store(self, report, fight, expires, summary):
+        self.remember((report, fight), expires, summary)
+        self.db.set_cached_fight(report, fight, expires, json.dumps(summary))
+
+    def remember(self, key, expires, summary):
+        self.entries[key] = (expires, summary)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
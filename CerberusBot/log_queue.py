@@ -0,0 +1,99 @@
+import asyncio
+import math
+import time
+import traceback
+from metrics import registry
+
+"""
+A queued log check and the user who submitted it.
+
+"""
+class LogCheckJob():
+    def __init__(self, user_id, func):
+        self.user_id = user_id
+        self.func = func
+        self.submitted = time.monotonic()
+
+"""
+Bounded queue of log checks processed by a fixed number of workers.
+
+Each user can have one check queued or running at a time and has to wait
+a cooldown between submissions. When the queue is full new checks are
+rejected instead of piling up browsers on the host.
+
+"""
+class LogCheckQueue():
+    def __init__(self, config):
+        self.config = config
+        self.workers = config.get("log_check_workers", config.get("browser_pool_size", 2))
+        self.max_size = config.get("log_queue_size", 50)
+        self.cooldown = config.get("log_check_cooldown", 30)
+        # Running average of how long a check takes, used for wait estimates
+        self.average_duration = config.get("log_check_estimate", 20)
+        self.queue = None
+        self.tasks = []
+        self.pending = []
+        self.active_users = set()
+        self.last_submission = {}
+
+    # Queues a check and returns its position and estimated wait in seconds, or an error message
+    def submit(self, user_id, func):
+        now = time.monotonic()
+        if user_id in self.active_users:
+            return (self.config["error_codes"]["failure"], self.config["error_messages"].get("log_check_in_progress", "Your previous logs are still being checked. Please wait for the result."))
+
+        last_submission = self.last_submission.get(user_id)
+        if last_submission is not None and now - last_submission < self.cooldown:
+            remaining = int(math.ceil(self.cooldown - (now - last_submission)))
+            return (self.config["error_codes"]["failure"], self.config["error_messages"].get("log_check_cooldown", "You are submitting logs too quickly. Please try again in (seconds): ") + str(remaining))
+
+        if len(self.pending) >= self.max_size:
+            return (self.config["error_codes"]["failure"], self.config["error_messages"].get("log_queue_full", "Too many logs are being checked right now. Please try again in a few minutes."))
+
+        self.start()
+        job = LogCheckJob(user_id, func)
+        self.pending.append(job)
+        self.active_users.add(user_id)
+        self.remember_submission(user_id, now)
+        self.queue.put_nowait(job)
+
+        position = len(self.pending)
+        return (self.config["error_codes"]["success"], (position, self.estimate_wait(position)))
+
+    def estimate_wait(self, position):
+        return int(math.ceil(position / self.workers) * self.average_duration)
+
+    def remember_submission(self, user_id, now):
+        self.last_submission[user_id] = now
+        if len(self.last_submission) > 1000:
+            for key in [key for key, value in self.last_submission.items() if now - value >= self.cooldown]:
+                del self.last_submission[key]
+
+    # Workers are started on first use since they need the running event loop
+    def start(self):
+        if self.queue is not None:
+            return
+        self.queue = asyncio.Queue()
+        for i in range(self.workers):
+            self.tasks.append(asyncio.ensure_future(self.work()))
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+            self.pending.remove(job)
+            start = time.monotonic()
+            registry.observe("queue_wait", start - job.submitted)
+            try:
+                await job.func()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.active_users.discard(job.user_id)
+                self.average_duration = 0.8 * self.average_duration + 0.2 * (time.monotonic() - start)
+                self.queue.task_done()
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.queue = None
@@ -0,0 +1,92 @@
+import time
+import discord
+from metrics import timer
+
+"""
+Resolves guilds and members without a REST round-trip whenever possible.
+
+The gateway cache (filled thanks to Intents.all()) is tried first. The REST
+API is only used for guilds missing from it because another shard serves them,
+or not chunked yet, and those results are kept for a short TTL until a member
+or role update event invalidates them.
+
+"""
+class MemberResolver():
+    def __init__(self, bot, config):
+        self.bot = bot
+        self.ttl = config.get("member_cache_ttl", 10 * 60)
+        self.guilds = {}
+        self.members = {}
+        self.users = {}
+        self.channels = {}
+
+    async def get_guild(self, guild_id):
+        guild = self.bot.get_guild(guild_id)
+        if guild is not None:
+            return guild
+
+        entry = self.guilds.get(guild_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        with timer("discord_fetch_guild"):
+            guild = await self.bot.fetch_guild(guild_id)
+        self.guilds[guild_id] = (time.monotonic() + self.ttl, guild)
+        return guild
+
+    # Returns the member of a guild, or None if the user is not in it
+    async def get_member(self, guild_id, user_id):
+        guild = self.bot.get_guild(guild_id)
+        if guild is not None:
+            member = guild.get_member(user_id)
+            # Guilds of this shard hold every member once chunked, so a miss means the user is not in the guild
+            if member is not None or guild.chunked:
+                return member
+
+        key = (guild_id, user_id)
+        entry = self.members.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        guild = await self.get_guild(guild_id)
+        try:
+            with timer("discord_fetch_member"):
+                member = await guild.fetch_member(user_id)
+        except discord.NotFound:
+            member = None
+        self.members[key] = (time.monotonic() + self.ttl, member)
+        return member
+
+    async def get_user(self, user_id):
+        user = self.bot.get_user(user_id)
+        if user is not None:
+            return user
+
+        entry = self.users.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        with timer("discord_fetch_user"):
+            user = await self.bot.fetch_user(user_id)
+        self.users[user_id] = (time.monotonic() + self.ttl, user)
+        return user
+
+    # Channels of guilds handled by another shard are only reachable over REST
+    async def get_channel(self, channel_id):
+        channel = self.bot.get_channel(channel_id)
+        if channel is not None:
+            return channel
+
+        entry = self.channels.get(channel_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        with timer("discord_fetch_channel"):
+            channel = await self.bot.fetch_channel(channel_id)
+        self.channels[channel_id] = (time.monotonic() + self.ttl, channel)
+        return channel
+
+    def invalidate_member(self, guild_id, user_id):
+        self.members.pop((guild_id, user_id), None)
+
+    def invalidate_guild(self, guild_id):
+        self.guilds.pop(guild_id, None)
+        for key in [key for key in self.members if key[0] == guild_id]:
+            del self.members[key]
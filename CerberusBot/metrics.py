@@ -0,0 +1,179 @@
+import functools
+import threading
+import time
+from aiohttp import web
+from contextlib import contextmanager
+
+"""
+Latency histograms per stage and outcome counters, shared by the whole bot.
+
+Stages are timed with "with timer(stage):" or the @timed(stage) decorator and
+outcomes are counted with count(name, label). Everything is exported in the
+Prometheus text format by MetricsServer and summarized by the !stats command.
+
+"""
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60]
+
+class Histogram():
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    # Estimates a percentile as the upper bound of the bucket it falls into
+    def percentile(self, fraction):
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for i, bound in enumerate(BUCKETS):
+            seen += self.bucket_counts[i]
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class Metrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, label, amount=1):
+        with self.lock:
+            key = (name, label)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            lines.append("# TYPE cerberus_stage_seconds histogram")
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS, histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append('cerberus_stage_seconds_bucket{stage="' + stage + '",le="' + str(bound) + '"} ' + str(cumulative))
+                lines.append('cerberus_stage_seconds_bucket{stage="' + stage + '",le="+Inf"} ' + str(histogram.count))
+                lines.append('cerberus_stage_seconds_sum{stage="' + stage + '"} ' + repr(histogram.sum))
+                lines.append('cerberus_stage_seconds_count{stage="' + stage + '"} ' + str(histogram.count))
+
+            names = sorted(set(name for name, label in self.counters))
+            for name in names:
+                lines.append("# TYPE cerberus_" + name + "_total counter")
+                for (counter_name, label), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append("cerberus_" + name + '_total{outcome="' + label + '"} ' + str(value))
+        return "\n".join(lines) + "\n"
+
+    # Short human readable summary for Discord
+    def render_summary(self):
+        lines = []
+        with self.lock:
+            lines.append("Stage                 count   mean    p50    p95")
+            for stage, histogram in sorted(self.histograms.items()):
+                mean = histogram.sum / histogram.count if histogram.count > 0 else 0.0
+                lines.append("%-20s %6d %6.2fs %5.2fs %5.2fs" % (stage, histogram.count, mean, histogram.percentile(0.5), histogram.percentile(0.95)))
+            if len(self.counters) > 0:
+                lines.append("")
+                for (name, label), value in sorted(self.counters.items()):
+                    lines.append("%-20s %6d" % (name + "/" + label, value))
+        return "\n".join(lines)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+registry = Metrics()
+
+# Reasons a log check can fail, counted as outcomes of "log_checks"
+FAILED = "failed"
+INVALID_URL = "invalid_url"
+BROWSER_BUSY = "browser_busy"
+TIMEOUT = "timeout"
+BROWSER_ERROR = "browser_error"
+NOTHING_RENDERED = "nothing_rendered"
+API_ERROR = "api_error"
+PARSE_FAILURE = "parse_failure"
+PLAYER_NOT_FOUND = "player_not_found"
+NO_ELIGIBLE_FIGHTS = "no_eligible_fights"
+
+"""
+A user facing error message which also carries why a log check failed.
+
+It is returned in place of the plain message, so the reply to the user stays
+the same while the outcome is counted by its reason rather than by its text.
+
+"""
+class Failure(str):
+    def __new__(cls, message, reason):
+        failure = super().__new__(cls, message)
+        failure.reason = reason
+        return failure
+
+    def __reduce__(self):
+        return (Failure, (str(self), self.reason))
+
+def get_failure_reason(message):
+    return getattr(message, "reason", FAILED)
+
+@contextmanager
+def timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(stage, time.perf_counter() - start)
+
+def timed(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, label, amount=1):
+    registry.count(name, label, amount)
+
+"""
+Serves the metrics in the Prometheus text format on a local HTTP port.
+
+"""
+class MetricsServer():
+    def __init__(self, config):
+        self.host = config.get("metrics_host", "127.0.0.1")
+        self.port = config.get("metrics_port")
+        self.runner = None
+
+    async def start(self):
+        if self.port is None or self.runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def handle_metrics(self, request):
+        return web.Response(text=registry.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,68 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from metrics import count
+
+# Tree walking parser of the worker process, only built when the html5lib engine is used
+html_parser = None
+
+# Parses a rendered FFLogs summary page into a plain summary dict, runs inside the worker processes
+def parse(page_source, engine="lxml"):
+    global html_parser
+    if engine == "html5lib":
+        from bs4 import BeautifulSoup
+        from web_parser import HTML_Parser
+        if html_parser is None:
+            html_parser = HTML_Parser({})
+        return html_parser.summarize_fight(BeautifulSoup(page_source, 'html5lib'))
+    from fflogs_extractor import extract_fight_summary
+    return extract_fight_summary(page_source)
+
+# Loads the parser modules so the first real parse does not pay for the imports
+def warm_up(engine="lxml"):
+    return parse("<html></html>", engine) is not None
+
+"""
+Pool of worker processes parsing rendered FFLogs pages.
+
+Parsing is pure Python CPU work holding the GIL, so it is moved out of the bot
+process and scales with the number of cores, while the rendering threads only
+wait on the browsers. Workers are spawned rather than forked, since the bot
+process runs threads and an event loop which must not be copied.
+
+"""
+class ParsePool():
+    def __init__(self, config):
+        self.workers = config.get("parse_workers", 2)
+        self.engine = config.get("log_parser_engine", "lxml")
+        self.executor = None
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            for i in range(self.workers):
+                self.executor.submit(warm_up, self.engine)
+        return self.executor
+
+    # Parses a page in a worker process, starting a fresh pool once if a worker died
+    async def parse(self, page_source):
+        loop = asyncio.get_event_loop()
+        executor = self.start()
+        try:
+            return await loop.run_in_executor(executor, parse, page_source, self.engine)
+        except BrokenProcessPool:
+            # Only the first caller to see the broken pool replaces it, the others retry on its replacement
+            if self.executor is executor:
+                count("parse_pool", "broken")
+                self.close()
+            return await loop.run_in_executor(self.start(), parse, page_source, self.engine)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
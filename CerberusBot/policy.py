@@ -1,49 +1,145 @@
+# Default DRS Rules, can be overridden through "drs_policy" in config.json
+DEFAULT_DRS_POLICY = {
+    "death_penalty": 10,
+    "wipe_penalty": 7,
+    "damage_weight": 3,
+    "healing_weight": 1,
+    # Boss Name -> Failed Mechanic -> Penalty per Death
+    "bosses": {
+        "Trinity Avowed Savage": {"Heat Shock": 5, "Cold Shock": 5},
+        "Trinité Féale Savage": {"Heat Shock": 5, "Cold Shock": 5},
+        "The Queen Savage": {"The Means": 5, "Queen's Justice": 5},
+        "Garde-La-Reine Savage": {"The Means": 5, "Queen's Justice": 5}
+    }
+}
+
+# Verdicts
+ACCEPTED = "accepted"
+MANUAL = "manual"
+REJECTED = "rejected"
+INVALID = "invalid"
+
 class Policy:
-    def __init__(self, config):
+    def __init__(self, config, rules=None):
         self.config = config
+        self.accept_threshold = config["accept_threshold"]
+        self.reject_threshold = config["reject_threshold"]
 
-    def check_drs_logs(self, data):
+        # Precompile Rule Table
+        if rules is None:
+            rules = dict(DEFAULT_DRS_POLICY)
+            rules.update(config.get("drs_policy", {}))
+        self.rules = rules
+        self.death_penalty = rules["death_penalty"]
+        self.wipe_penalty = rules["wipe_penalty"]
+        self.damage_weight = rules["damage_weight"]
+        self.healing_weight = rules["healing_weight"]
+        self.boss_penalties = {boss: dict(mechanics) for boss, mechanics in rules["bosses"].items()}
+
+    # Returns a copy of this policy with other thresholds or rules, for comparing changes
+    def with_changes(self, accept_threshold=None, reject_threshold=None, rules=None):
+        config = dict(self.config)
+        if accept_threshold is not None:
+            config["accept_threshold"] = accept_threshold
+        if reject_threshold is not None:
+            config["reject_threshold"] = reject_threshold
+        return Policy(config, rules if rules is not None else self.rules)
+
+    # Returns the score of a parsed log, or None if the boss is not part of the rule table
+    def score_drs_logs(self, data):
         # Unpack Fight Data
         boss_name = data[0]
         kill_status = data[1][0]
-        fight_time = data[1][1]
         dmg_done = data[2]
         heal_done = data[3]
         deaths = data[4]
 
+        mechanic_penalties = self.boss_penalties.get(boss_name)
+        if mechanic_penalties is None:
+            return None
+
         score = 0
 
         # Add Penalty for deaths
-        num_deaths = len(deaths)
-        score += num_deaths * 10
+        score += len(deaths) * self.death_penalty
 
         # Add Penalty for wipes
         if "Wipe" in kill_status:
-            score += 7
+            score += self.wipe_penalty
 
         # Easy penalty is damage and healing is good
-        score -= dmg_done * 3
-        score -= heal_done
+        score -= dmg_done * self.damage_weight
+        score -= heal_done * self.healing_weight
 
         # Add Penalty for failed mechanics
-        trinity_names = ["Trinity Avowed Savage", "Trinité Féale Savage"]
-        queen_names = ["The Queen Savage", "Garde-La-Reine Savage"]
-        if boss_name in trinity_names:
-            for death in deaths:
-                death_mech = death[1]
-                if death_mech == "Heat Shock" or death_mech == "Cold Shock":
-                    score += 5
-        elif boss_name in queen_names:
-            for death in deaths:
-                death_mech = death[1]
-                if death_mech == "The Means" or death_mech == "Queen's Justice":
-                    score += 5
+        for death in deaths:
+            score += mechanic_penalties.get(death[1], 0)
+
+        return score
+
+    # Boss names of the fights this policy can score
+    def get_bosses(self):
+        return set(self.boss_penalties)
+
+    # Names the configured bosses for messages, e.g. "A, B or C"
+    def get_boss_list(self):
+        bosses = list(self.boss_penalties)
+        if len(bosses) <= 1:
+            return "".join(bosses)
+        return ", ".join(bosses[:-1]) + " or " + bosses[-1]
+
+    # Picks the (fight, data, score) with the best score out of several (fight, data) pairs, or None if none can be scored
+    def select_best_drs_logs(self, logs):
+        best = None
+        for fight, data in logs:
+            score = self.score_drs_logs(data)
+            if score is not None and (best is None or score < best[2]):
+                best = (fight, data, score)
+        return best
+
+    def get_verdict(self, score):
+        if score is None:
+            return INVALID
+        if score <= self.accept_threshold:
+            return ACCEPTED
+        elif score > self.reject_threshold:
+            return REJECTED
         else:
-            return (self.config["error_codes"]["failure"], boss_name + " is not a valid boss for DRS logs. Please provide logs for either Trinity Avowed Savage or The Queen Savage")
+            return MANUAL
+
+    def check_drs_logs(self, data):
+        score = self.score_drs_logs(data)
+        verdict = self.get_verdict(score)
 
-        if score <= self.config["accept_threshold"]:
+        if verdict == INVALID:
+            return (self.config["error_codes"]["failure"], data[0] + " is not a valid boss for DRS logs. Please provide logs for " + self.get_boss_list())
+        elif verdict == ACCEPTED:
             return (self.config["error_codes"]["success"], True)
-        elif score > self.config["reject_threshold"]:
+        elif verdict == REJECTED:
             return (self.config["error_codes"]["success"], False)
         else:
             return (self.config["error_codes"]["manual_check"], "The logs you provided has been flagged for manual review. Once our staff has had a look at it you will recieve a message.")
+
+    # Scores many parsed logs in one pass, returning their scores and the count of each verdict
+    def score_batch(self, datas):
+        scores = [self.score_drs_logs(data) for data in datas]
+        counts = {ACCEPTED: 0, MANUAL: 0, REJECTED: 0, INVALID: 0}
+        for score in scores:
+            counts[self.get_verdict(score)] += 1
+        return (scores, counts)
+
+    # Re-scores parsed logs under this policy and another one and reports how the verdicts would move
+    def compare(self, datas, other):
+        datas = list(datas)
+        current_scores, current_counts = self.score_batch(datas)
+        other_scores, other_counts = other.score_batch(datas)
+
+        changes = {}
+        for current_score, other_score in zip(current_scores, other_scores):
+            current_verdict = self.get_verdict(current_score)
+            other_verdict = other.get_verdict(other_score)
+            if current_verdict != other_verdict:
+                key = current_verdict + " -> " + other_verdict
+                changes[key] = changes.get(key, 0) + 1
+
+        return {"current": current_counts, "proposed": other_counts, "changes": changes}
@@ -0,0 +1,44 @@
+import argparse
+import json
+import time
+from db import DB
+from policy import Policy
+from util import load_config
+
+"""
+Re-scores stored log submissions under proposed thresholds or rules.
+
+    python rescore.py --accept-threshold -25 --reject-threshold 5
+    python rescore.py --rules new_rules.json --boss "The Queen Savage" --days 30
+
+"""
+def main():
+    arg_parser = argparse.ArgumentParser(description="Show how changed thresholds or rules would affect stored log verdicts.")
+    arg_parser.add_argument("--config", default="config.json")
+    arg_parser.add_argument("--db", default="users.db")
+    arg_parser.add_argument("--accept-threshold", type=float)
+    arg_parser.add_argument("--reject-threshold", type=float)
+    arg_parser.add_argument("--rules", help="JSON file with a drs_policy rule table")
+    arg_parser.add_argument("--boss")
+    arg_parser.add_argument("--days", type=float, help="only re-score submissions from the last N days")
+    args = arg_parser.parse_args()
+
+    config = load_config(args.config)
+    policy = Policy(config)
+    rules = None
+    if args.rules is not None:
+        rules = dict(policy.rules)
+        rules.update(load_config(args.rules))
+    proposed = policy.with_changes(args.accept_threshold, args.reject_threshold, rules)
+
+    since = None
+    if args.days is not None:
+        since = time.time() - args.days * 24 * 60 * 60
+
+    db = DB(args.db)
+    datas = (data for row, data in db.iter_submissions(boss=args.boss, since=since))
+    print(json.dumps(policy.compare(datas, proposed), indent=2))
+    db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import asyncio
+import time
+import traceback
+import aiohttp
+from lodestone_stream import NAME, WORLD
+from metrics import count, timer
+
+"""
+Periodically re-checks the Lodestone profiles of all validated users.
+
+Profiles are fetched with bounded concurrency over the fetcher's keep-alive
+session using conditional requests, so unchanged pages cost a 304 and no
+parsing. Only the name/world header is read, stopping the download as soon as
+it has been parsed, and results are written back to the database in batches.
+
+"""
+class ReverificationSweep():
+    def __init__(self, config, db, fetcher, web, on_change=None):
+        self.config = config
+        self.db = db
+        self.fetcher = fetcher
+        self.web = web
+        self.on_change = on_change
+        self.interval = config.get("reverify_interval_hours", 24) * 60 * 60
+        self.concurrency = config.get("reverify_concurrency", 8)
+        self.batch_size = config.get("reverify_batch_size", 100)
+        self.task = None
+
+    def start(self):
+        if self.task is None and self.config.get("reverify_enabled", True):
+            self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        delay = self.get_first_delay()
+        while True:
+            await asyncio.sleep(delay)
+            delay = self.interval
+            try:
+                with timer("reverify_sweep"):
+                    await self.sweep()
+            except Exception:
+                traceback.print_exc()
+
+    # Schedules from the stored check times, so restarting the bot does not push the next sweep back
+    def get_first_delay(self):
+        oldest = self.db.get_oldest_profile_check()
+        if oldest is None:
+            return self.interval
+        return max(0, oldest + self.interval - time.time())
+
+    # Checks every validated profile once and returns the number of changed characters
+    async def sweep(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = []
+        changes = []
+        failed = []
+
+        missing = self.db.count_validated_without_profile()
+        if missing > 0:
+            count("reverify", "no_profile", missing)
+            print(missing, "validated users have no stored Lodestone profile and are skipped until they run !verify again")
+
+        async def check(profile):
+            async with semaphore:
+                result = await self.check_profile(profile)
+            if result is None:
+                failed.append(profile[0])
+                return
+            results.append(result)
+            if result[1] != profile[1] or result[2] != profile[3]:
+                changes.append((profile, result))
+            if len(results) >= self.batch_size:
+                self.flush(results)
+
+        await asyncio.gather(*[check(profile) for profile in self.db.get_validated_profiles()])
+        self.flush(results)
+        if len(failed) > 0:
+            self.db.touch_profiles(failed, time.time())
+
+        for profile, result in changes:
+            count("reverify", "changed")
+            if self.on_change is not None:
+                await self.on_change(profile[0], profile[1], result[1], result[2])
+        return len(changes)
+
+    def flush(self, results):
+        if len(results) > 0:
+            self.db.update_profiles(list(results))
+            del results[:]
+
+    # Returns the updated (user ID, name, world, ETag, Last-Modified, checked) of a profile, or None if it could not be read
+    async def check_profile(self, profile):
+        user_id, name, url, world, etag, last_modified = profile
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        try:
+            with timer("reverify_fetch"):
+                async with self.fetcher.get_session().get(self.fetcher.get_lodestone_request_url(url), headers=headers) as response:
+                    if response.status == 304:
+                        count("reverify", "not_modified")
+                        return (user_id, name, world, etag, last_modified, time.time())
+                    if response.status != 200:
+                        count("reverify", "failed")
+                        return None
+                    parser = await self.fetcher.stream_lodestone_page(response, (NAME, WORLD))
+                    etag = response.headers.get("ETag")
+                    last_modified = response.headers.get("Last-Modified")
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            count("reverify", "failed")
+            return None
+
+        status_code, data = self.web.lodestone_stream_result(parser)
+        if status_code != self.config["error_codes"]["success"]:
+            count("reverify", "failed")
+            return None
+        count("reverify", "checked")
+        return (user_id, data[0], data[1], etag, last_modified, time.time())
@@ -0,0 +1,25 @@
+import asyncio
+
+"""
+Coalesces concurrent calls with the same key into one in-flight call.
+
+The first caller for a key starts the work, everyone arriving before it
+finishes awaits the same result. Cancelling one caller does not cancel
+the shared call for the others.
+
+"""
+class SingleFlight():
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, func, *args):
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args))
+            self.calls[key] = future
+            future.add_done_callback(lambda done: self.forget(key, done))
+        return await asyncio.shield(future)
+
+    def forget(self, key, future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
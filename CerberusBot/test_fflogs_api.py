@@ -0,0 +1,153 @@
+import re
+import unittest
+import aiohttp
+from aiohttp import web
+from fflogs_api import FFLogsAPIClient
+from metrics import API_ERROR, get_failure_reason
+
+"""
+Runs FFLogsAPIClient against a local stub of the FFLogs OAuth and GraphQL endpoints.
+    python -m unittest test_fflogs_api
+
+"""
+CONFIG = {
+    "fflogs_client_id": "client",
+    "fflogs_client_secret": "secret",
+    "error_codes": {"success": 0, "failure": 1},
+    "error_messages": {"broken_log_parsing": "broken", "fflogs_api_error": "api error"}
+}
+
+PLAYERS = ["Tank One", "Healer One", "Dps One"]
+
+def get_fight(fight):
+    return {"id": fight, "name": "Trinity Avowed", "kill": fight % 2 == 1, "difficulty": 101, "startTime": 1000, "endTime": 1000 + fight * 60 * 1000}
+
+def get_fight_report(fight):
+    return {
+        "fights": [get_fight(fight)],
+        "playerDetails": {"data": {"playerDetails": {"tanks": [{"name": PLAYERS[0]}], "healers": [{"name": PLAYERS[1]}], "dps": [{"name": PLAYERS[2]}]}}},
+        "damage": {"data": {"entries": [{"name": PLAYERS[0], "total": 100 * fight}, {"name": PLAYERS[1], "total": 100}, {"name": PLAYERS[2], "total": 200}]}},
+        "healing": {"data": {"entries": [{"name": PLAYERS[1], "total": 500}]}},
+        "deaths": {"data": {"entries": [{"name": PLAYERS[2], "timestamp": 1000 + fight * 1000, "killingBlow": {"name": "Heat Shock"}}]}}
+    }
+
+class StubFFLogs():
+    def __init__(self):
+        self.token_requests = 0
+        self.queries = []
+        self.revoked = set()
+        self.runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/oauth/token", self.handle_token)
+        app.router.add_post("/api/v2/client", self.handle_graphql)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        return "http://127.0.0.1:" + str(self.runner.addresses[0][1])
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def handle_token(self, request):
+        self.token_requests += 1
+        return web.json_response({"access_token": "token" + str(self.token_requests), "expires_in": 3600})
+
+    async def handle_graphql(self, request):
+        token = request.headers.get("Authorization", "")[len("Bearer "):]
+        if not token.startswith("token") or token in self.revoked:
+            return web.Response(status=401)
+        payload = await request.json()
+        self.queries.append(payload)
+
+        query = payload["query"]
+        if "table(" not in query:
+            report = {"fights": [get_fight(fight) for fight in range(1, 4)]}
+        elif "fights" in payload["variables"]:
+            report = get_fight_report(payload["variables"]["fights"][0])
+        else:
+            report = {}
+            for fight in re.findall("f([0-9]+)_fights", query):
+                for key, value in get_fight_report(int(fight)).items():
+                    report["f" + fight + "_" + key] = value
+        return web.json_response({"data": {"reportData": {"report": report}}})
+
+class FFLogsAPIClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.stub = StubFFLogs()
+        url = await self.stub.start()
+        self.session = aiohttp.ClientSession()
+        config = dict(CONFIG, fflogs_api_url=url + "/api/v2/client", fflogs_token_url=url + "/oauth/token")
+        self.client = FFLogsAPIClient(config, lambda: self.session)
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.stub.stop()
+
+    async def test_token_is_cached(self):
+        await self.client.get_fight_summary("abc", "1")
+        await self.client.get_fight_summary("abc", "2")
+        self.assertEqual(self.stub.token_requests, 1)
+        self.assertEqual(len(self.stub.queries), 2)
+
+    async def test_expired_token_is_refreshed(self):
+        await self.client.get_fight_summary("abc", "1")
+        self.client.token_expires = 0
+        status_code, summary = await self.client.get_fight_summary("abc", "1")
+        self.assertEqual(status_code, 0)
+        self.assertEqual(self.stub.token_requests, 2)
+        self.assertEqual(self.client.token, "token2")
+
+    async def test_revoked_token_is_refreshed_and_retried(self):
+        await self.client.get_fight_summary("abc", "1")
+        self.stub.revoked.add("token1")
+        status_code, summary = await self.client.get_fight_summary("abc", "2")
+        self.assertEqual(status_code, 0)
+        self.assertEqual(summary["fight"], "2")
+        self.assertEqual(self.stub.token_requests, 2)
+
+    async def test_rejected_credentials_fail_after_one_retry(self):
+        self.stub.revoked.update(["token1", "token2", "token3"])
+        status_code, data = await self.client.get_fight_summary("abc", "1")
+        self.assertEqual((status_code, data), (1, "api error"))
+        self.assertEqual(get_failure_reason(data), API_ERROR)
+        self.assertEqual(self.stub.token_requests, 2)
+
+    async def test_single_fight_query(self):
+        status_code, summary = await self.client.get_fight_summary("abc", "3")
+        self.assertEqual(status_code, 0)
+        self.assertEqual(self.stub.queries[0]["variables"], {"code": "abc", "fights": [3]})
+        self.assertEqual(summary["report"], "abc")
+        self.assertEqual(summary["fight"], "3")
+        self.assertEqual(summary["boss"], "Trinity Avowed Savage")
+        self.assertEqual(summary["kill_info"], ["Kill", 180])
+        self.assertEqual(summary["players"], PLAYERS)
+        self.assertEqual(summary["damage"], [[PLAYERS[0], 50.0], [PLAYERS[1], 16.67], [PLAYERS[2], 33.33]])
+        self.assertEqual(summary["healing"], [[PLAYERS[1], 100.0]])
+        self.assertEqual(summary["deaths"], [[PLAYERS[2], 3, "Heat Shock"]])
+
+    async def test_last_fight_is_resolved(self):
+        status_code, summary = await self.client.get_fight_summary("abc", "last")
+        self.assertEqual(status_code, 0)
+        self.assertEqual(summary["fight"], "3")
+        self.assertEqual(len(self.stub.queries), 2)
+
+    async def test_aliased_multi_fight_query(self):
+        status_code, summaries = await self.client.get_fight_summaries("abc", ["1", "3"])
+        self.assertEqual(status_code, 0)
+        self.assertEqual(len(self.stub.queries), 1)
+        self.assertIn("f1_damage: table(fightIDs: [1], dataType: DamageDone)", self.stub.queries[0]["query"])
+        self.assertIn("f3_damage: table(fightIDs: [3], dataType: DamageDone)", self.stub.queries[0]["query"])
+        self.assertEqual([summary["fight"] for summary in summaries], ["1", "3"])
+        self.assertEqual([summary["kill_info"] for summary in summaries], [["Kill", 60], ["Kill", 180]])
+        single_status, single = await self.client.get_fight_summary("abc", "3")
+        self.assertEqual(summaries[1], single)
+
+    async def test_report_fights(self):
+        status_code, fights = await self.client.get_report_fights("abc")
+        self.assertEqual(status_code, 0)
+        self.assertEqual(fights, [("1", "Trinity Avowed Savage"), ("2", "Trinity Avowed Savage"), ("3", "Trinity Avowed Savage")])
+
+if __name__ == "__main__":
+    unittest.main()
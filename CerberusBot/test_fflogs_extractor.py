@@ -0,0 +1,44 @@
+import os
+import unittest
+from bs4 import BeautifulSoup
+from fflogs_extractor import extract_fight_summary
+from fixtures import FixtureStore
+from web_parser import HTML_Parser
+
+"""
+Checks that the lxml extractor and the html5lib tree walk read the same summary from the recorded FFLogs pages.
+    python -m unittest test_fflogs_extractor
+
+"""
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_fixtures")
+
+class FightSummaryEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.web = HTML_Parser({})
+        self.pages = dict(FixtureStore(FIXTURE_DIR).load_all("fflogs"))
+
+    def test_engines_agree_on_every_fixture(self):
+        self.assertGreater(len(self.pages), 0)
+        for key, page_source in self.pages.items():
+            with self.subTest(fixture=key):
+                self.assertEqual(extract_fight_summary(page_source), self.web.summarize_fight(BeautifulSoup(page_source, 'html5lib')))
+
+    def test_compact_page(self):
+        summary = extract_fight_summary(self.pages["compact-kill"])
+        self.assertEqual(summary["boss"], "Trinity Avowed Savage")
+        self.assertEqual(summary["kill_info"], ["Kill", 432])
+        self.assertEqual(summary["players"], ["Alpha Ray", "Bea Tris", "Cid Nan"])
+        self.assertEqual(summary["damage"], [["Alpha Ray", 31.25], ["Bea Tris", 12.5], ["Cid Nan", 56.25]])
+        self.assertEqual(summary["healing"], [["Bea Tris", 88.0], ["Alpha Ray", 12.0]])
+        self.assertEqual(summary["deaths"], [["Cid Nan", 83, "Heat Shock"], ["Alpha Ray", 284, ""], ["Cid Nan", 301, "Cold Shock"]])
+
+    # Whitespace between the table cells must not hide the percentages and death times
+    def test_indented_page(self):
+        summary = extract_fight_summary(self.pages["indented-wipe"])
+        self.assertEqual(summary["kill_info"], ["Wipe", 605])
+        self.assertEqual(summary["damage"], [["Dee Light", 60.0], ["Al Bert", 40.0]])
+        self.assertEqual(summary["healing"], [["Al Bert", 100.0]])
+        self.assertEqual(summary["deaths"], [["Dee Light", 598, "The Means"]])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,8 @@
 import json
 
-def load_config():
+def load_config(path="config.json"):
     json_string = ""
-    with open("config.json") as file:
+    with open(path) as file:
         json_string = file.read()
     config = json.loads(json_string)
     return config
@@ -1,34 +1,69 @@
 import re
+import threading
+import traceback
 import requests
-from selenium import webdriver
-from selenium.common.exceptions import TimeoutException
-from selenium.webdriver import FirefoxOptions
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.common.by import By
-from bs4 import BeautifulSoup
+from fixtures import FixtureStore
+from lodestone_stream import CHARACTER_FIELDS, LodestoneStreamParser
+from metrics import BROWSER_BUSY, BROWSER_ERROR, INVALID_URL, NOTHING_RENDERED, PARSE_FAILURE, PLAYER_NOT_FOUND, TIMEOUT, Failure, timed, timer
 
 """
 Responsible for parsing the HTML of Lodestone and FFLogs.
 
+Selenium, BeautifulSoup and lxml are imported on first use, so processes which
+only verify characters never load the scraping stack.
+
 """
 class HTML_Parser():
     lodestone_regex = "^(https:\/\/)(eu|na)\.finalfantasyxiv.com/lodestone/character/([0-9]{6,10})\/$"
     fflogs_regex = "^(https:\/\/)www.fflogs.com/reports/([a-zA-Z0-9]+)[\/]?#fight=(last|[0-9]{1,2})"
+    fflogs_report_regex = "^(https:\/\/)www.fflogs.com/reports/([a-zA-Z0-9]+)[\/]?$"
+    fflogs_fight_link_regex = r"""<a\s[^>]*href=["'][^"']*#fight=([0-9]+)\b[^"']*["'][^>]*>(.*?)</a>"""
 
     def __init__(self, config):
         self.config = config
+        self.browsers = None
+        self.browsers_lock = threading.Lock()
+
+        # Record every fetched page to disk when "fixture_record_dir" is set
+        self.recorder = None
+        if config.get("fixture_record_dir"):
+            self.recorder = FixtureStore(config["fixture_record_dir"])
 
     # Parses the HTML of a Lodestone URL to get player name and character profile
     def get_lodestone_data(self, lodestone_url):
         # Validate Lodestone URL
-        regex_result = re.search(HTML_Parser.lodestone_regex, lodestone_url)
-        if (regex_result is None) or (not lodestone_url == regex_result.group()):
+        if not self.is_valid_lodestone_url(lodestone_url):
             return (self.config["error_codes"]["failure"], self.config["error_messages"]["invalid_lodestone_url"])
 
         # Get Data from Lodestone
         http_req = requests.get(lodestone_url)
-        html = BeautifulSoup(http_req.text, 'html5lib')
+        self.record_lodestone_page(lodestone_url, http_req.text)
+        return self.parse_lodestone_html(http_req.text)
+
+    def record_lodestone_page(self, lodestone_url, page_source):
+        if self.recorder is not None:
+            character_id = re.search(HTML_Parser.lodestone_regex, lodestone_url).group(3)
+            self.recorder.record("lodestone", character_id, page_source)
+
+    def is_valid_lodestone_url(self, lodestone_url):
+        regex_result = re.search(HTML_Parser.lodestone_regex, lodestone_url)
+        if (regex_result is None) or (not lodestone_url == regex_result.group()):
+            return False
+        return True
+
+    # The browser pool is started by the first log check
+    def get_browsers(self):
+        with self.browsers_lock:
+            if self.browsers is None:
+                from browser_pool import BrowserPool
+                self.browsers = BrowserPool(self.config)
+            return self.browsers
+
+    # Extracts player name, character profile and world from the HTML of a Lodestone character page
+    @timed("lodestone_parse")
+    def parse_lodestone_html(self, page_source):
+        from bs4 import BeautifulSoup
+        html = BeautifulSoup(page_source, 'html5lib')
 
         lodestone_bio = html.find("div", class_="character__selfintroduction")
         lodestone_name = html.find("p", class_="frame__chara__name")
@@ -45,70 +80,263 @@ class HTML_Parser():
 
         return (self.config["error_codes"]["success"], (lodestone_name.contents[0], lodestone_bio.contents[0], lodestone_world))
 
-    # Parses the HTML of an FFLogs URL to get data about damage done and deaths
-    def get_log_data(self, fflogs_url, name):
-        # Validate FFLogs URL
+    # Starts an incremental parse of a Lodestone character page, by default for the same data as parse_lodestone_html
+    def lodestone_stream_parser(self, fields=CHARACTER_FIELDS, encoding=None):
+        return LodestoneStreamParser(fields, encoding or "utf-8", self.recorder is not None)
+
+    # Returns the data read by a Lodestone stream parser in the same format as the full page parsers
+    def lodestone_stream_result(self, parser):
+        result = parser.result()
+        if result is None:
+            return (self.config["error_codes"]["failure"], self.config["error_messages"]["lodestone_parsing_error"])
+        return (self.config["error_codes"]["success"], result)
+
+    # Returns the report code and fight of an FFLogs URL, or None if the URL is invalid
+    def parse_fflogs_url(self, fflogs_url):
         regex_result = re.search(HTML_Parser.fflogs_regex, fflogs_url)
         if regex_result is None:
-            return (self.config["error_codes"]["failure"], self.config["error_messages"]["invalid_logs_url"])
-        fflogs_url = regex_result.group()
+            return None
+        return (regex_result.group(2), regex_result.group(3))
+
+    # Returns the report code of an FFLogs URL without a fight, or None if the URL points to a single fight or is invalid
+    def parse_fflogs_report_url(self, fflogs_url):
+        regex_result = re.search(HTML_Parser.fflogs_report_regex, fflogs_url)
+        if regex_result is None:
+            return None
+        return regex_result.group(2)
+
+    def get_fflogs_fight_url(self, report_code, fight):
+        return "https://www.fflogs.com/reports/" + report_code + "#fight=" + str(fight)
+
+    # Runs render(driver) on a pooled browser and returns (status code, result), always checking the browser back in
+    def render_with_browser(self, render, pages=1):
+        from browser_pool import BrowserPoolTimeout
+        from selenium.common.exceptions import TimeoutException, WebDriverException
+
+        browsers = self.get_browsers()
+        try:
+            with timer("browser_checkout"):
+                session = browsers.checkout()
+        except BrowserPoolTimeout:
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"].get("browser_busy", "All log checkers are busy right now. Please try again in a few minutes."), BROWSER_BUSY))
 
-        # Run the fight summary page through Selenium to get the HTML contents rendered by JavaScript
-        opts = FirefoxOptions()
-        opts.add_argument("--headless")
-        driver = webdriver.Firefox(executable_path=self.config["gecko_driver_path"], firefox_options=opts)
-        driver.get(fflogs_url+"&type=summary")
         try:
-            ep = EC.presence_of_element_located((By.ID, "summary-damage-done-0"))
-            WebDriverWait(driver, 15).until(ep)
+            result = render(session.driver)
         except TimeoutException:
-            driver.quit()
-            return (self.config["error_codes"]["failure"], self.config["error_messages"]["selenium_timeout"])
+            browsers.checkin(session)
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["selenium_timeout"], TIMEOUT))
+        except WebDriverException:
+            browsers.checkin(session, broken=True)
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["selenium_timeout"], BROWSER_ERROR))
+        except Exception:
+            # A dead geckodriver surfaces as connection errors, so the browser is thrown away instead of leaking its slot
+            traceback.print_exc()
+            browsers.checkin(session, broken=True)
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["selenium_timeout"], BROWSER_ERROR))
+        browsers.checkin(session, pages=pages)
+        return (self.config["error_codes"]["success"], result)
+
+    # Returns the rendered summary page and the fight number it resolved to
+    def render_fight_summary(self, fflogs_url):
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.common.by import By
+
+        # Validate FFLogs URL
+        regex_result = re.search(HTML_Parser.fflogs_regex, fflogs_url)
+        if regex_result is None:
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["invalid_logs_url"], INVALID_URL))
+        fflogs_url = regex_result.group()
+
+        # Run the fight summary page through a pooled Selenium browser to get the HTML contents rendered by JavaScript
+        def render(driver):
+            fight = regex_result.group(3)
+            with timer("page_load"):
+                driver.get(fflogs_url+"&type=summary")
+            with timer("page_wait"):
+                ep = EC.presence_of_element_located((By.ID, "summary-damage-done-0"))
+                WebDriverWait(driver, 15).until(ep)
+                page_source = driver.page_source
 
-        html = BeautifulSoup(driver.page_source, 'html5lib')
-        driver.quit()
+            # Remember the actual fight number if FFLogs rewrote "fight=last" in the address bar
+            resolved_fight = re.search("#fight=([0-9]+)\\b", driver.current_url)
+            if resolved_fight is not None:
+                fight = resolved_fight.group(1)
+            return (page_source, fight)
 
+        status_code, data = self.render_with_browser(render)
+        if status_code != self.config["error_codes"]["success"]:
+            return (status_code, data)
+
+        if self.recorder is not None:
+            self.recorder.record("fflogs", regex_result.group(2) + "-" + data[1], data[0])
+
+        return (status_code, data)
+
+    # Returns (fight, link text or None) for every fight listed on the overview page of a report
+    def render_report_fights(self, report_code):
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.common.by import By
+
+        def render(driver):
+            with timer("page_load"):
+                driver.get("https://www.fflogs.com/reports/" + report_code)
+            with timer("page_wait"):
+                ep = EC.presence_of_element_located((By.CSS_SELECTOR, "a[href*='#fight=']"))
+                WebDriverWait(driver, 15).until(ep)
+                return driver.page_source
+
+        status_code, page_source = self.render_with_browser(render)
+        if status_code != self.config["error_codes"]["success"]:
+            return (status_code, page_source)
+        return (status_code, self.parse_report_fights(page_source))
+
+    # The overview links of a fight name its boss, which lets other encounters be skipped before any summary is rendered
+    def parse_report_fights(self, page_source):
+        labels = {}
+        for fight, text in re.findall(HTML_Parser.fflogs_fight_link_regex, page_source, re.DOTALL):
+            text = " ".join(re.sub("<[^>]*>", " ", text).split())
+            labels.setdefault(int(fight), [])
+            if len(text) > 0:
+                labels[int(fight)].append(text)
+        return [(str(fight), " ".join(labels[fight]) or None) for fight in sorted(labels)]
+
+    # Renders the summaries of several fights of a report in parallel tabs of one browser
+    def render_fight_summaries(self, report_code, fights):
+        from selenium.common.exceptions import TimeoutException
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.common.by import By
+
+        def render(driver):
+            pages = []
+            urls = [self.get_fflogs_fight_url(report_code, fight) + "&type=summary" for fight in fights]
+
+            # Start every page load before waiting for any of them, so the fights render at the same time
+            with timer("page_load"):
+                driver.get(urls[0])
+                handles = [driver.current_window_handle]
+                for url in urls[1:]:
+                    known = set(driver.window_handles)
+                    driver.execute_script("window.open(arguments[0], '_blank');", url)
+                    handles.append([handle for handle in driver.window_handles if handle not in known][0])
+
+            # A fight which does not render is skipped, the others can still be checked
+            for handle, fight in zip(handles, fights):
+                driver.switch_to.window(handle)
+                try:
+                    with timer("page_wait"):
+                        ep = EC.presence_of_element_located((By.ID, "summary-damage-done-0"))
+                        WebDriverWait(driver, 15).until(ep)
+                        pages.append((driver.page_source, fight))
+                except TimeoutException:
+                    pass
+
+            for handle in handles[1:]:
+                driver.switch_to.window(handle)
+                driver.close()
+            driver.switch_to.window(handles[0])
+            return pages
+
+        status_code, pages = self.render_with_browser(render, pages=len(fights))
+        if status_code != self.config["error_codes"]["success"]:
+            return (status_code, pages)
+        if len(pages) == 0:
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["selenium_timeout"], NOTHING_RENDERED))
+        if self.recorder is not None:
+            for page_source, fight in pages:
+                self.recorder.record("fflogs", report_code + "-" + fight, page_source)
+        return (status_code, pages)
+
+    # Parses a rendered summary page with the configured engine, "lxml" (default) or "html5lib"
+    @timed("html_parse")
+    def parse_fight_summary(self, page_source):
+        if self.config.get("log_parser_engine", "lxml") == "html5lib":
+            from bs4 import BeautifulSoup
+            return self.summarize_fight(BeautifulSoup(page_source, 'html5lib'))
+        from fflogs_extractor import extract_fight_summary
+        return extract_fight_summary(page_source)
+
+    # Collects the fight data of every player from a parsed summary page
+    def summarize_fight(self, html):
+        return {
+            "boss": self.fflogs_get_boss_name(html),
+            "kill_info": self.fflogs_get_kill_info(html),
+            "players": self.fflogs_get_players(html),
+            "damage": self.fflogs_get_percent_table(html, "summary-damage-done-0"),
+            "healing": self.fflogs_get_percent_table(html, "summary-healing-done-0"),
+            "deaths": self.fflogs_get_death_table(html)
+        }
+
+    # A summary is worth caching only if every part of the page could be parsed
+    def is_complete_summary(self, summary):
+        for key in ["boss", "kill_info", "players", "damage", "healing", "deaths"]:
+            if summary[key] is None:
+                return False
+        return True
+
+    # Picks the data of a single player out of a fight summary
+    def select_player_data(self, summary, name):
         # Check if User is part of the logs
-        if not self.fflogs_contains_user(html, name):
-            return (self.config["error_codes"]["failure"], self.config["error_messages"]["log_user_not_found"] + str(name))
+        players = summary["players"]
+        if players is None or not any(name in player for player in players):
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["log_user_not_found"] + str(name), PLAYER_NOT_FOUND))
 
         # Get Boss Name
-        boss_name = self.fflogs_get_boss_name(html)
+        boss_name = summary["boss"]
         if boss_name is None:
-            return (self.config["error_codes"]["failure"], self.config["error_messages"]["broken_log_parsing"])
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["broken_log_parsing"], PARSE_FAILURE))
 
         # Get Kill Info and Fight Time
-        fight_metadata = self.fflogs_get_kill_info(html)
+        fight_metadata = summary["kill_info"]
         if fight_metadata is None:
-            return (self.config["error_codes"]["failure"], self.config["error_messages"]["broken_log_parsing"])
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["broken_log_parsing"], PARSE_FAILURE))
 
         # Get Damage % Done
-        dmg_done = self.fflogs_get_percent_done(html, "summary-damage-done-0", name)
+        dmg_done = self.select_percent_done(summary["damage"], name)
         if dmg_done is None:
-            return (self.config["error_codes"]["failure"], self.config["error_messages"]["broken_log_parsing"])
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["broken_log_parsing"], PARSE_FAILURE))
 
         # Get Healing % Done
-        heal_done = self.fflogs_get_percent_done(html, "summary-healing-done-0", name)
+        heal_done = self.select_percent_done(summary["healing"], name)
         if heal_done is None:
-            return (self.config["error_codes"]["failure"], self.config["error_messages"]["broken_log_parsing"])
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["broken_log_parsing"], PARSE_FAILURE))
 
         # Get Deaths
-        deaths = self.fflogs_get_deaths(html, name)
+        deaths = self.select_deaths(summary["deaths"], name)
         if deaths is None:
-            return (self.config["error_codes"]["failure"], self.config["error_messages"]["broken_log_parsing"])
+            return (self.config["error_codes"]["failure"], Failure(self.config["error_messages"]["broken_log_parsing"], PARSE_FAILURE))
 
         # Return Parsed Data
         return (self.config["error_codes"]["success"], (boss_name, fight_metadata, dmg_done, heal_done, deaths))
 
-    def fflogs_contains_user(self, html, username):
+    # The first table entry containing the name counts, players missing from the table did nothing
+    def select_percent_done(self, table, username):
+        if table is None:
+            return None
+        for entry_name, percent_done in table:
+            if username in entry_name:
+                return percent_done
+        return 0.0
+
+    def select_deaths(self, table, username):
+        if table is None:
+            return None
+        deaths = []
+        for entry_name, death_time, death_mechanic in table:
+            if username in entry_name:
+                if death_time is None:
+                    return None
+                deaths.append((death_time, death_mechanic))
+        return deaths
+
+    def fflogs_get_players(self, html):
         try:
             raid_comp_table = html.find("table", {"class": "composition-table"})
-            raid_comp_table_entry = raid_comp_table.find(lambda tag: tag.name == "a" and username in tag.text)
-            if raid_comp_table_entry is None:
-                return False
-            return True
+            return [entry.text for entry in raid_comp_table.find_all("a")]
         except:
-            return False
+            return None
 
     def fflogs_get_kill_info(self, html):
         try:
@@ -148,57 +376,68 @@ class HTML_Parser():
         except:
             return None
 
-    def fflogs_get_deaths(self, html, username):
+    # Returns [name, death time, death mechanic] for every death, with None times for unreadable entries
+    def fflogs_get_death_table(self, html):
         try:
             deaths_table = html.find("table", {"id": "summary-deaths-0"})
 
             # Compile List of Deaths
             deaths = []
-            death_entries = deaths_table.findAll(lambda tag: tag.name == "a" and username in tag.text)
-            for death_entry in death_entries:
-                death_entry = death_entry.parent
-
-                # Get Death Mechanic
-                death_mechanic_parent = death_entry.next_sibling
-                death_mechanic = death_mechanic_parent.find("span", id=lambda name: name.startswith("death-ability"))
-                if death_mechanic is None:
-                    death_mechanic = ""
-                else:
-                    death_mechanic = death_mechanic.contents[0]
-                print(death_mechanic)
-
-                # Get Death Time
-                death_time_parent = death_mechanic_parent.next_sibling
-                death_time = death_time_parent.contents[0]
-                death_time = death_time.replace("\n", "")
-                death_time = death_time.replace(" ", "")
-                time_data = death_time.split(":")
-                death_time = (int(time_data[0]) * 60) + int(time_data[1])
-                print(death_time)
+            for death_entry in deaths_table.find_all("a"):
+                try:
+                    entry_name = death_entry.text
+                    death_entry = death_entry.parent
+
+                    # Get Death Mechanic, skipping whitespace between the cells like the lxml extractor
+                    death_mechanic_parent = death_entry.find_next_sibling()
+                    death_mechanic = death_mechanic_parent.find("span", id=lambda name: name.startswith("death-ability"))
+                    if death_mechanic is None:
+                        death_mechanic = ""
+                    else:
+                        death_mechanic = str(death_mechanic.contents[0])
+
+                    # Get Death Time
+                    death_time_parent = death_mechanic_parent.find_next_sibling()
+                    death_time = death_time_parent.contents[0]
+                    death_time = death_time.replace("\n", "")
+                    death_time = death_time.replace(" ", "")
+                    time_data = death_time.split(":")
+                    death_time = (int(time_data[0]) * 60) + int(time_data[1])
+                except:
+                    death_time, death_mechanic = None, None
 
                 # Add Death to List
-                deaths.append((death_time, death_mechanic))
+                deaths.append([entry_name, death_time, death_mechanic])
             return deaths
         except:
             return None
 
-    def fflogs_get_percent_done(self, html, table_id, username):
+    # Returns [name, percent] for every player in a damage or healing table, with None for unreadable entries
+    def fflogs_get_percent_table(self, html, table_id):
         try:
             table = html.find("table", {"id": table_id})
-            table_entry = table.find(lambda tag: tag.name == "a" and username in tag.text)
-            if table_entry is None:
-                return 0.0
-            percent_entry = table_entry.parent.next_sibling
-            percent_done = percent_entry.find("div", {"class": "report-amount-percent"}).contents[0]
-            percent_done = float(percent_done.replace("%", ""))
-            return percent_done
+
+            entries = []
+            for table_entry in table.find_all("a"):
+                try:
+                    percent_entry = table_entry.parent.find_next_sibling()
+                    percent_done = percent_entry.find("div", {"class": "report-amount-percent"}).contents[0]
+                    percent_done = float(percent_done.replace("%", ""))
+                except:
+                    percent_done = None
+                entries.append([table_entry.text, percent_done])
+            return entries
         except:
             return None
 
     def fflogs_get_boss_name(self, html):
         try:
             boss_element = html.find("div", {"id": "filter-fight-boss-text"})
-            boss_name = boss_element.contents[0]
+            boss_name = str(boss_element.contents[0])
             return boss_name
         except:
             return None
+
+    def close(self):
+        if self.browsers is not None:
+            self.browsers.close()